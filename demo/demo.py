@@ -17,7 +17,9 @@ import matplotlib.pyplot as plt
 import argparse
 from typing import List
 import os
+import sys
 import yaml
+import multiprocessing as mp
 
 from roman.params.submap_align_params import SubmapAlignInputOutput, SubmapAlignParams
 from roman.align.submap_align import submap_align
@@ -33,6 +35,55 @@ from roman.params.data_params import DataParams
 
 import mapping
 
+def map_run(run: str, args: argparse.Namespace, run_env: str = None, log_file: str = None):
+    """
+    Maps a single run and saves the map to {output_dir}/map/{run}.pkl.
+
+    Args:
+        run (str): Run name
+        args (argparse.Namespace): Command line arguments
+        run_env (str, optional): Environment variable set to the run name. Defaults to None.
+        log_file (str, optional): If given, stdout and stderr are redirected to this file. 
+            Defaults to None.
+    """
+    if log_file is not None:
+        log = open(log_file, 'w', buffering=1)
+        sys.stdout = log
+        sys.stderr = log
+
+    try:
+        # shell: export RUN=run
+        if run_env is not None:
+            os.environ[run_env] = run
+        
+        print(f"Mapping: {run}")
+        mapping_viz_params = \
+            mapping.VisualizationParams(
+                viz_map=args.viz_map,
+                viz_observations=args.viz_observations,
+                viz_3d=args.viz_3d,
+                vid_rate=args.vid_rate,
+                save_img_data=args.save_img_data
+            )
+        mapping.mapping(
+            params_path=args.params,
+            output_path=os.path.join(args.output_dir, "map", f"{run}"),
+            run_name=run,
+            max_time=args.max_time,
+            viz_params=mapping_viz_params,
+            pipelined=args.pipelined,
+            columnar=args.columnar_map
+        )
+    finally:
+        if log_file is not None:
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+            log.close()
+
+def _map_run_worker(run_and_args):
+    run, args, run_env = run_and_args
+    map_run(run, args, run_env, log_file=os.path.join(args.output_dir, "map", f"{run}.log"))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--params', default=None, type=str, help='Path to params directory. ' +
@@ -55,6 +106,15 @@ if __name__ == '__main__':
     parser.add_argument('--max-time', type=float, default=None, help='If the input data is too large, this allows a maximum time' +
                         'to be set, such that if the mapping will be chunked into max_time increments and fused together')
 
+    parser.add_argument('--pipelined', action='store_true', 
+                        help='Overlap frame loading, FastSAM, and mapping in a threaded pipeline')
+    parser.add_argument('--columnar-map', action='store_true',
+                        help='Also save maps in the memory-mappable columnar format and load ' +
+                        'them from it for alignment')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of runs to map in parallel worker processes. Each run is ' +
+                        'logged to {output_dir}/map/{run}.log')
+
     parser.add_argument('--skip-map', action='store_true', help='Skip mapping')
     parser.add_argument('--skip-align', action='store_true', help='Skip alignment')
     parser.add_argument('--skip-rpgo', action='store_true', help='Skip robust pose graph optimization')
@@ -91,33 +151,19 @@ if __name__ == '__main__':
     
     if not args.skip_map:
         
-        for i, run in enumerate(data_params.runs):
-            if args.skip_indices and i in args.skip_indices:
-                continue
-                
-            # mkdir $output_dir/map
-            args.output = os.path.join(args.output_dir, "map", f"{run}")
+        map_runs = [run for i, run in enumerate(data_params.runs) 
+                    if not (args.skip_indices and i in args.skip_indices)]
 
-            # shell: export RUN=run
-            if data_params.run_env is not None:
-                os.environ[data_params.run_env] = run
-            
-            print(f"Mapping: {run}")
-            mapping_viz_params = \
-                mapping.VisualizationParams(
-                    viz_map=args.viz_map,
-                    viz_observations=args.viz_observations,
-                    viz_3d=args.viz_3d,
-                    vid_rate=args.vid_rate,
-                    save_img_data=args.save_img_data
-                )
-            mapping.mapping(
-                params_path=args.params,
-                output_path=args.output,
-                run_name=run,
-                max_time=args.max_time,
-                viz_params=mapping_viz_params
-            )
+        if args.jobs > 1:
+            # each run is mapped in a fresh process so that the run environment variable 
+            # and any GPU state are not shared between runs
+            print(f"Mapping {len(map_runs)} runs with {args.jobs} jobs: {', '.join(map_runs)}")
+            with mp.get_context('spawn').Pool(args.jobs, maxtasksperchild=1) as pool:
+                pool.map(_map_run_worker, [(run, args, data_params.run_env) for run in map_runs], 
+                         chunksize=1)
+        else:
+            for run in map_runs:
+                map_run(run, args, data_params.run_env)
         
     if not args.skip_align:
         # TODO: support ground truth pose file for validation
@@ -130,8 +176,9 @@ if __name__ == '__main__':
                     continue
                 output_dir = os.path.join(args.output_dir, "align", f"{data_params.runs[i]}_{data_params.runs[j]}")
                 os.makedirs(output_dir, exist_ok=True)
-                input_files = [os.path.join(args.output_dir, "map", f"{data_params.runs[i]}.pkl"),
-                            os.path.join(args.output_dir, "map", f"{data_params.runs[j]}.pkl")]
+                map_ext = "columnar" if args.columnar_map else "pkl"
+                input_files = [os.path.join(args.output_dir, "map", f"{data_params.runs[i]}.{map_ext}"),
+                            os.path.join(args.output_dir, "map", f"{data_params.runs[j]}.{map_ext}")]
                 sm_io = SubmapAlignInputOutput(
                     inputs=input_files,
                     output_dir=output_dir,
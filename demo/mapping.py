@@ -29,6 +29,7 @@ from roman.params.data_params import DataParams
 from roman.params.mapper_params import MapperParams
 from roman.params.fastsam_params import FastSAMParams
 from roman.utils import expandvars_recursive
+from roman.map.map import load_roman_map
 
 from robotdatapy.data import ImgData
 from merge_demo_output import merge_demo_output
@@ -63,7 +64,9 @@ def run(
     fastsam_params: FastSAMParams, 
     mapper_params: MapperParams,
     output_path: str,
-    viz_params: VisualizationParams = VisualizationParams()
+    viz_params: VisualizationParams = VisualizationParams(),
+    pipelined: bool = False,
+    columnar: bool = False
 ):
     
     runner = ROMANMapRunner(data_params=data_params, 
@@ -107,8 +110,11 @@ def run(
         video = cv.VideoWriter(video_file, fc, fps, 
                                (width*num_panes, height))
 
-    for t in runner.times():
-        img_t = runner.update(t)
+    if pipelined:
+        img_outputs = runner.run_pipelined()
+    else:
+        img_outputs = (runner.update(t) for t in runner.times())
+    for img_t in img_outputs:
         if vid and img_t is not None:
             video.write(img_t)
             
@@ -125,9 +131,15 @@ def run(
     # Output results
     pkl_path = os.path.expanduser(expandvars(output_path)) + ".pkl"
     pkl_file = open(pkl_path, 'wb')
-    pickle.dump(runner.mapper.get_roman_map(), pkl_file, -1)
+    roman_map = runner.mapper.get_roman_map()
+    pickle.dump(roman_map, pkl_file, -1)
     logging.info(f"Saved tracker, poses_flu_history to file: {pkl_path}.")
     pkl_file.close()
+    
+    if columnar:
+        columnar_path = os.path.expanduser(expandvars(output_path)) + ".columnar"
+        roman_map.to_columnar(columnar_path)
+        logging.info(f"Saved columnar map to: {columnar_path}.")
 
     timing_file = os.path.expanduser(expandvars(output_path)) + ".time.txt"
     with open(timing_file, 'w') as f:
@@ -138,6 +150,13 @@ def run(
         f.write(f"total: {np.mean(runner.processing_times.total_times):.3f}\n")
         f.write(f"TOTAL TIMES\n")
         f.write(f"total: {np.sum(runner.processing_times.total_times):.2f}\n")
+        if data_params.prefetch_frames > 0:
+            f.write(f"PREFETCH\n")
+            for name, data in [('img', runner.img_data), ('depth', runner.depth_data)]:
+                stats = data.stats()
+                f.write(f"{name}: hit rate {stats['hit_rate']:.2f}, " + 
+                        f"decode time {stats['mean_decode_time']:.3f}\n")
+                data.close()
     
     if viz_params.save_img_data:
         img_data_path = os.path.expanduser(expandvars(output_path)) + ".img_data.npz"
@@ -153,7 +172,9 @@ def mapping(
     output_path: str,
     run_name: str = None,
     max_time: float = None,
-    viz_params: VisualizationParams = VisualizationParams()
+    viz_params: VisualizationParams = VisualizationParams(),
+    pipelined: bool = False,
+    columnar: bool = False
 ):
     data_params_path = expandvars_recursive(f"{params_path}/data.yaml")
     mapper_params_path = expandvars_recursive(f"{params_path}/mapper.yaml")
@@ -173,16 +194,20 @@ def mapping(
                     'relative': True}
                 
                 run(data_params, fastsam_params, mapper_params, 
-                    output_path=f"{output_path}_{mapping_iter}", viz_params=viz_params)
+                    output_path=f"{output_path}_{mapping_iter}", viz_params=viz_params, 
+                    pipelined=pipelined)
                 mapping_iter += 1
         except:
             demo_output_files = [f"{output_path}_{mi}.pkl" for mi in range(mapping_iter)]
             merge_demo_output(demo_output_files, f"{output_path}.pkl")
+            if columnar:
+                load_roman_map(f"{output_path}.pkl").to_columnar(f"{output_path}.columnar")
     
     else:
         data_params, fastsam_params, mapper_params = \
             extract_params(data_params_path, fastsam_params_path, mapper_params_path, run_name=run_name)
-        run(data_params, fastsam_params, mapper_params, output_path, viz_params)
+        run(data_params, fastsam_params, mapper_params, output_path, viz_params, pipelined, 
+            columnar)
 
 
 if __name__ == '__main__':
@@ -196,6 +221,10 @@ if __name__ == '__main__':
     parser.add_argument('--vid-rate', type=float, help='Video playback rate', default=1.0)
     parser.add_argument('-d', '--save-img-data', action='store_true', help='Save video frames as ImgData class')
     parser.add_argument('-r', '--run', type=str, help='Robot run', default=None)
+    parser.add_argument('--pipelined', action='store_true', 
+                        help='Overlap frame loading, FastSAM, and mapping in a threaded pipeline')
+    parser.add_argument('--columnar', action='store_true', 
+                        help='Also save the map in the memory-mappable columnar format')
     args = parser.parse_args()
 
     viz_params = VisualizationParams(
@@ -211,5 +240,7 @@ if __name__ == '__main__':
         output_path=args.output,
         run_name=args.run,
         max_time=args.max_time,
-        viz_params=viz_params
+        viz_params=viz_params,
+        pipelined=args.pipelined,
+        columnar=args.columnar
     )
\ No newline at end of file
@@ -7,11 +7,10 @@ from roman.map.map import load_roman_map, ROMANMap
 
 def merge_demo_output(input_files, output_file):
     
-    roman_maps = []
-    for input_file in input_files:
-        roman_maps.append(load_roman_map(input_file))
-            
-    merged = ROMANMap.concatenate(roman_maps)
+    # maps are loaded one at a time while concatenating and are not used afterwards, so their 
+    # segments do not need to be copied
+    roman_maps = (load_roman_map(input_file) for input_file in input_files)
+    merged = ROMANMap.concatenate(roman_maps, deep_copy=False)
         
     with open(os.path.expanduser(output_file), 'wb') as f:
         pickle.dump(merged, f)
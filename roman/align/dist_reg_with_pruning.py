@@ -26,11 +26,13 @@ class DistRegWithPruning(ObjectRegistration):
         self.roll_pitch_thresh = roll_pitch_thresh
         assert not self.use_gravity or self.dim == 3, "Gravity can only be used with 3D points"
     
-    def register(self, map1: List[Object], map2: List[Object]):
+    def register(self, map1: List[Object], map2: List[Object], 
+                 map1_features: np.ndarray = None, map2_features: np.ndarray = None):
         if len(map1) == 0 or len(map2) == 0:
             return np.array([[]])
         clipper = self._setup_clipper()
-        clipper, A_init = self._score_pruned_assoc(clipper, map1, map2) # not all to all associations
+        clipper, A_init = self._score_pruned_assoc(clipper, map1, map2, 
+            map1_features, map2_features) # not all to all associations
         clipper.solve()
         Ain = clipper.get_selected_associations()
         
@@ -68,7 +70,7 @@ class DistRegWithPruning(ObjectRegistration):
         shape_attrs = np.array([self._object_shape_attributes(obj) for obj in object_map]) # n x 4
         return shape_attrs[indices, :]
     
-    def _score_pruned_assoc(self, clipper, map1, map2):
+    def _score_pruned_assoc(self, clipper, map1, map2, map1_cl=None, map2_cl=None):
         A_all = clipperpy.utils.create_all_to_all(len(map1), len(map2))
 
         # prune based on semantics
@@ -89,8 +91,10 @@ class DistRegWithPruning(ObjectRegistration):
         to_delete = np.any(violates_ratio, axis=1) # n
         A_put = np.delete(A_put, to_delete, axis=0)       
 
-        map1_cl = np.array([self._object_to_clipper_list(p) for p in map1])
-        map2_cl = np.array([self._object_to_clipper_list(p) for p in map2])
+        if map1_cl is None:
+            map1_cl = self.object_features(map1)
+        if map2_cl is None:
+            map2_cl = self.object_features(map2)
         self._check_clipper_arrays(map1_cl, map2_cl)
 
         clipper.score_pairwise_consistency(map1_cl.T, map2_cl.T, A_put)
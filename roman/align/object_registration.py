@@ -19,15 +19,44 @@ class ObjectRegistration():
     def __init__(self, dim=3):
         self.dim = dim
 
-    def register(self, map1: List[Object], map2: List[Object]):
+    def register(self, map1: List[Object], map2: List[Object], 
+                 map1_features: np.ndarray = None, map2_features: np.ndarray = None):
+        """
+        Finds associations between objects in map1 and map2.
+
+        Args:
+            map1 (List[Object]): Object list in frame 1
+            map2 (List[Object]): Object list in frame 2
+            map1_features (np.ndarray, shape=(n1,d), optional): Precomputed object_features of 
+                map1. Computed from map1 if None. Defaults to None.
+            map2_features (np.ndarray, shape=(n2,d), optional): Precomputed object_features of 
+                map2. Computed from map2 if None. Defaults to None.
+
+        Returns:
+            np.array, shape=(n,2): Associated object indices
+        """
         if len(map1) == 0 or len(map2) == 0:
             return np.array([[]])
         clipper = self._setup_clipper()
-        clipper, A_init = self._clipper_score_all_to_all(clipper, map1, map2)
+        clipper, A_init = self._clipper_score_all_to_all(clipper, map1, map2, 
+                                                         map1_features, map2_features)
         clipper.solve()
         Ain = clipper.get_selected_associations()
         return Ain
     
+    def object_features(self, map: List[Object]) -> np.ndarray:
+        """
+        Computes the features used by CLIPPER for each object. The features of an object list 
+        can be computed once and passed to register for every registration it is part of.
+
+        Args:
+            map (List[Object]): Object list
+
+        Returns:
+            np.array, shape=(n,d): Contiguous float64 feature matrix with one row per object
+        """
+        return np.array([self._object_to_clipper_list(obj) for obj in map], dtype=np.float64)
+    
     def _setup_clipper(self):
         raise NotImplementedError
     
@@ -37,11 +66,14 @@ class ObjectRegistration():
     def _check_clipper_arrays(self, map1_cl, map2_cl):
         return
     
-    def _clipper_score_all_to_all(self, clipper, map1: List[Object], map2: List[Object]):
+    def _clipper_score_all_to_all(self, clipper, map1: List[Object], map2: List[Object], 
+                                  map1_cl: np.ndarray = None, map2_cl: np.ndarray = None):
         A_init = clipperpy.utils.create_all_to_all(len(map1), len(map2))
 
-        map1_cl = np.array([self._object_to_clipper_list(p) for p in map1])
-        map2_cl = np.array([self._object_to_clipper_list(p) for p in map2])
+        if map1_cl is None:
+            map1_cl = self.object_features(map1)
+        if map2_cl is None:
+            map2_cl = self.object_features(map2)
         self._check_clipper_arrays(map1_cl, map2_cl)
 
         clipper.score_pairwise_consistency(map1_cl.T, map2_cl.T, A_init)
@@ -13,10 +13,11 @@ class RansacReg(ObjectRegistration):
         self.max_iteration = max_iteration
         super().__init__(0.0, 0.0, 0.0, dim)
     
-    def register(self, map1: List[PointCloudObject], map2: List[PointCloudObject]):
+    def register(self, map1: List[PointCloudObject], map2: List[PointCloudObject], 
+                 map1_features: np.ndarray = None, map2_features: np.ndarray = None):
         # For RANSAC, we take the center of each object's pointcloud.
-        pcd_ransac_1 = [seg.center.reshape(-1) for seg in map1]
-        pcd_ransac_2 = [seg.center.reshape(-1) for seg in map2]
+        pcd_ransac_1 = map1_features if map1_features is not None else self.object_features(map1)
+        pcd_ransac_2 = map2_features if map2_features is not None else self.object_features(map2)
 
         # for seg in map1:
         #     pcd_ransac_1.append(seg.center)
@@ -51,5 +52,8 @@ class RansacReg(ObjectRegistration):
         )
         
         return np.asarray(result.correspondence_set)
+    
+    def _object_to_clipper_list(self, object: PointCloudObject):
+        return object.center.reshape(-1).tolist()
 
         
\ No newline at end of file
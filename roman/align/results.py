@@ -28,6 +28,7 @@ class SubmapAlignResults:
     timing_list: List[float]
     submap_align_params: SubmapAlignParams
     submap_io: SubmapAlignInputOutput
+    prefilter_skip_mat: np.array = None
     
     def save(self):
         pkl_file = open(self.submap_io.output_pkl, 'wb')
@@ -100,6 +101,8 @@ def save_submap_align_results(results: SubmapAlignResults, submaps, roman_maps:
         f.write(f"Total number of submaps: {len(submaps[0])} x {len(submaps[1])} = {len(submaps[0])*len(submaps[1])}\n")
         f.write(f"Average time per registration: {np.mean(results.timing_list):.4f} seconds\n")
         f.write(f"Total time: {np.sum(results.timing_list):.4f} seconds\n")
+        if results.prefilter_skip_mat is not None:
+            f.write(f"Pairs skipped by prefilter: {np.sum(results.prefilter_skip_mat)}\n")
         f.write(f"Total number of objects: {np.sum([len(submap) for submap in submaps[0] + submaps[1]])}\n")
         f.write(f"Average number of obects per map: {np.mean([len(submap) for submap in submaps[0] + submaps[1]]):.2f}\n")
     
@@ -172,7 +175,7 @@ def save_submap_align_results(results: SubmapAlignResults, submaps, roman_maps:
                             segment_json = {}
                             segment_json['robot_name'] = results.submap_io.robot_names[i]
                             segment_json['segment_index'] = segment.id
-                            segment_json['centroid_odom'] = np.mean(segment.points, axis=0).tolist()
+                            segment_json['centroid_odom'] = segment.mean.reshape(-1).tolist()
                             e = segment.normalized_eigenvalues()
                             segment_json['shape_attributes'] = {'volume': segment.volume, 
                                                                 'linearity': segment.linearity(e), 
@@ -81,11 +81,14 @@ class ROMANRegistration(ObjectRegistration):
         clipper = clipperpy.CLIPPERPairwiseAndSingle(invariant, params)
         return clipper
     
-    def _clipper_score_all_to_all(self, clipper, map1: List[Object], map2: List[Object]):
+    def _clipper_score_all_to_all(self, clipper, map1: List[Object], map2: List[Object], 
+                                  map1_cl: np.ndarray = None, map2_cl: np.ndarray = None):
         A_init = clipperpy.utils.create_all_to_all(len(map1), len(map2))
 
-        map1_cl = np.array([self._object_to_clipper_list(p) for p in map1])
-        map2_cl = np.array([self._object_to_clipper_list(p) for p in map2])
+        if map1_cl is None:
+            map1_cl = self.object_features(map1)
+        if map2_cl is None:
+            map2_cl = self.object_features(map2)
         self._check_clipper_arrays(map1_cl, map2_cl)
 
         clipper.score_pairwise_and_single_consistency(map1_cl.T, map2_cl.T, A_init)
@@ -7,11 +7,12 @@ import matplotlib.pyplot as plt
 import os
 from tqdm import tqdm
 from typing import List
+from scipy.sparse import csr_matrix
 import open3d as o3d
 import clipperpy
 import time
 import json
-from copy import deepcopy
+import multiprocessing as mp
 import yaml
 
 from robotdatapy.data.pose_data import PoseData
@@ -60,7 +61,8 @@ def submap_align(sm_params: SubmapAlignParams, sm_io: SubmapAlignInputOutput):
     if sm_io.input_type_pkl:
         submap_params = SubmapParams.from_submap_align_params(sm_params)
         submap_params.use_minimal_data = True
-        roman_maps = [load_roman_map(sm_io.inputs[i]) for i in range(2)]
+        roman_maps = [load_roman_map(sm_io.inputs[i], minimal_data=True, 
+                                     center_ref=submap_params.object_center_ref) for i in range(2)]
         submaps = [submaps_from_roman_map(
             roman_maps[i], submap_params, gt_pose_data[i]) for i in range(2)]
     elif sm_io.input_type_json: # TODO: re-implement support for json files
@@ -83,92 +85,52 @@ def submap_align(sm_params: SubmapAlignParams, sm_io: SubmapAlignInputOutput):
     T_ij_hat_mat = np.zeros((len(submaps[0]), len(submaps[1]), 4, 4))*np.nan
     associated_objs_mat = [[[] for _ in range(len(submaps[1]))] for _ in range(len(submaps[0]))] # cannot be numpy array since each element is a different sized array
 
-    # Registration method
+    # segment ids of each submap, used to exclude common segments in single robot loop closures
+    segment_ids = [[np.array([seg.id for seg in sm.segments]) for sm in submaps[k]] 
+                   for k in range(2)]
+    
+    # registration features are computed once per submap and reused for every pair
     registration = sm_params.get_object_registration()
+    features = [[registration.object_features(sm.segments) for sm in submaps[k]] 
+                for k in range(2)]
+    
+    # skip registering submap pairs with too few semantically similar segment pairs
+    skip_mat = np.zeros((len(submaps[0]), len(submaps[1])), dtype=bool)
+    if sm_params.prefilter_min_pairs > 0:
+        skip_mat = semantic_pair_counts(submaps[0], submaps[1], sm_params.cosine_min) \
+            < sm_params.prefilter_min_pairs
+        print(f"Prefilter skipped {np.sum(skip_mat)} of {skip_mat.size} submap pairs " + 
+              f"({100*np.mean(skip_mat) if skip_mat.size > 0 else 0.0:.1f}%)")
 
+    # Registration method
+    if sm_params.num_workers > 1:
+        # shard rows of the submap grid across worker processes, each of which builds its 
+        # own registration object. imap keeps rows in order so results match the serial path
+        with mp.Pool(sm_params.num_workers, initializer=_init_align_worker,
+                     initargs=(submaps, segment_ids, features, skip_mat, sm_params, 
+                               gt_pose_data[0] is not None, gt_pose_data[1] is not None)) as pool:
+            row_results = list(tqdm(pool.imap(_align_worker_row, range(len(submaps[0]))), 
+                                    total=len(submaps[0])))
+    else:
+        row_results = [
+            [_align_submap_pair(submaps[0][i], submaps[1][j], segment_ids[0][i], segment_ids[1][j],
+                                features[0][i], features[1][j], registration, sm_params, 
+                                gt_pose_data[0] is not None, gt_pose_data[1] is not None,
+                                skip_registration=skip_mat[i, j])
+                for j in range(len(submaps[1]))]
+            for i in tqdm(range(len(submaps[0])))
+        ]
 
-    # iterate over pairs of submaps and create registration results
-    for i in tqdm(range(len(submaps[0]))):
-        for j in (range(len(submaps[1]))):
-            
-            if submaps[0][i].has_gt and submaps[1][j].has_gt:
-                submap_distance = norm(submaps[0][i].position_gt - submaps[1][j].position_gt)
-            else:
-                submap_distance = norm(submaps[0][i].position - submaps[1][j].position)
-            if submap_distance < sm_params.submap_radius*2:
-                robots_nearby_mat[i, j] = submap_distance
-
-            submap_i = deepcopy(submaps[0][i])
-            submap_j = deepcopy(submaps[1][j])
-            if sm_params.single_robot_lc: # self loop closures
-                ids_i = set([seg.id for seg in submap_i.segments])
-                ids_j = set([seg.id for seg in submap_j.segments])
-                common_ids = ids_i.intersection(ids_j)
-                for sm in [submap_i, submap_j]:
-                    to_rm = [seg for seg in sm.segments if seg.id in common_ids]
-                    for seg in to_rm:
-                        sm.segments.remove(seg)
-
-            # determine correct T_ij
-            if gt_pose_data[0] is not None:
-                T_wi = submaps[0][i].pose_gravity_aligned_gt
-            else:
-                T_wi = submaps[0][i].pose_gravity_aligned
-            if gt_pose_data[1] is not None:
-                T_wj = submaps[1][j].pose_gravity_aligned_gt
-            else:
-                T_wj = submaps[1][j].pose_gravity_aligned
-            T_ij = np.linalg.inv(T_wi) @ T_wj
-            if not np.isnan(robots_nearby_mat[i, j]):
-                relative_yaw_angle = transform_to_xyzrpy(T_ij)[5]
-                submap_yaw_diff_mat[i, j] = np.abs(np.rad2deg(relative_yaw_angle))
-                
-            # register the submaps
-            try:
-                start_t = time.time()
-                associations = registration.register(submap_i.segments, submap_j.segments)
-                timing_list.append(time.time() - start_t)
-                
-                if sm_params.dim == 2:
-                    T_ij_hat = registration.T_align(submap_i.segments, submap_j.segments, associations)
-                    T_error = np.linalg.inv(T_ij_hat) @ T_ij
-                    _, _, theta = transform_to_xytheta(T_error)
-                    dist = np.linalg.norm(T_error[:sm_params.dim, 3])
-
-                elif sm_params.dim == 3:
-                    T_ij_hat = registration.T_align(submap_i.segments, submap_j.segments, associations)
-                    if sm_params.force_rm_upside_down:
-                        xyzrpy = transform_to_xyzrpy(T_ij_hat)
-                        if np.abs(xyzrpy[3]) > np.deg2rad(90.) or np.abs(xyzrpy[4]) > np.deg2rad(90.):
-                            raise GravityConstraintError
-                    if sm_params.force_rm_lc_roll_pitch:
-                        T_ij_hat = transform_rm_roll_pitch(T_ij_hat)
-                    T_error = np.linalg.inv(T_ij_hat) @ T_ij
-                    theta = Rot.from_matrix(T_error[:3, :3]).magnitude()
-                    dist = np.linalg.norm(T_error[:sm_params.dim, 3])
-                else:
-                    raise ValueError("Invalid dimension")
-                
-            except (InsufficientAssociationsException, GravityConstraintError) as ex:
-                timing_list.append(time.time() - start_t)
-                T_ij_hat = np.zeros((4, 4))*np.nan
-                theta = 180.0
-                dist = 1e6
-                associations = []
-            
-            if not np.isnan(robots_nearby_mat[i, j]):
-                clipper_angle_mat[i, j] = np.abs(np.rad2deg(theta))
-                clipper_dist_mat[i, j] = dist
-            else:
-                clipper_angle_mat[i, j] = np.nan
-                clipper_dist_mat[i, j] = np.nan
-
-            clipper_num_associations[i, j] = len(associations)
-            clipper_percent_associations[i, j] = len(associations) / np.mean([len(submap_i), len(submap_j)])
-            
-            T_ij_mat[i, j] = T_ij
-            T_ij_hat_mat[i, j] = T_ij_hat
-            associated_objs_mat[i][j] = associations
+    for i, row in enumerate(row_results):
+        for j, pair_results in enumerate(row):
+            robots_nearby_mat[i, j], submap_yaw_diff_mat[i, j], clipper_angle_mat[i, j], \
+                clipper_dist_mat[i, j], clipper_num_associations[i, j], \
+                clipper_percent_associations[i, j], T_ij_mat[i, j], T_ij_hat_mat[i, j], \
+                associated_objs_mat[i][j], registration_time = pair_results
+            # pairs skipped by the semantic prefilter are not registered and are left out of the
+            # timing statistics, so timing_list has one entry per registered pair
+            if registration_time is not None:
+                timing_list.append(registration_time)
 
     # save results
     results = SubmapAlignResults(
@@ -182,6 +144,172 @@ def submap_align(sm_params: SubmapAlignParams, sm_io: SubmapAlignInputOutput):
         associated_objs_mat=associated_objs_mat,
         timing_list=timing_list,
         submap_align_params=sm_params,
-        submap_io=sm_io
+        submap_io=sm_io,
+        prefilter_skip_mat=skip_mat
     )
-    save_submap_align_results(results, submaps, roman_maps)
\ No newline at end of file
+    save_submap_align_results(results, submaps, roman_maps)
+
+def semantic_pair_counts(submaps1: List[Submap], submaps2: List[Submap], 
+                         cosine_min: float) -> np.ndarray:
+    """
+    Counts, for every pair of submaps, the segment pairs whose semantic descriptors have a 
+    cosine similarity of at least cosine_min. All pairs are scored with one product of the 
+    stacked descriptors.
+
+    Args:
+        submaps1 (List[Submap]): First list of submaps
+        submaps2 (List[Submap]): Second list of submaps
+        cosine_min (float): Minimum cosine similarity of similar segments
+
+    Returns:
+        np.ndarray, shape=(len(submaps1), len(submaps2)): Number of similar segment pairs
+    """
+    segments = [[seg for sm in submaps for seg in sm.segments] for submaps in [submaps1, submaps2]]
+    if len(segments[0]) == 0 or len(segments[1]) == 0:
+        return np.zeros((len(submaps1), len(submaps2)), dtype=np.int64)
+    assert all(seg.semantic_descriptor is not None for seg in segments[0] + segments[1]), \
+        "Segments must have semantic descriptors"
+
+    descriptors, membership = [], []
+    for submaps, segs in zip([submaps1, submaps2], segments):
+        descriptors.append(np.array([seg.semantic_descriptor.reshape(-1) for seg in segs]))
+        # (num submaps, num segments) matrix assigning segments to submaps
+        submap_idx = np.repeat(np.arange(len(submaps)), [len(sm) for sm in submaps])
+        membership.append(csr_matrix((np.ones(len(segs)), (submap_idx, np.arange(len(segs)))),
+                                     shape=(len(submaps), len(segs))))
+    
+    similar = (descriptors[0] @ descriptors[1].T >= cosine_min).astype(np.float64)
+    return np.rint(membership[0] @ (membership[1] @ similar.T).T).astype(np.int64)
+
+def _align_submap_pair(submap_i: Submap, submap_j: Submap, ids_i: np.ndarray, ids_j: np.ndarray,
+                       features_i: np.ndarray, features_j: np.ndarray, registration, 
+                       sm_params: SubmapAlignParams, use_gt_i: bool, use_gt_j: bool,
+                       skip_registration: bool = False):
+    """
+    Registers a single pair of submaps. Submaps are not modified or copied.
+
+    Args:
+        submap_i (Submap): Submap from the first map
+        submap_j (Submap): Submap from the second map
+        ids_i (np.ndarray): Segment ids of submap_i
+        ids_j (np.ndarray): Segment ids of submap_j
+        features_i (np.ndarray): Registration object_features of submap_i segments
+        features_j (np.ndarray): Registration object_features of submap_j segments
+        registration (ObjectRegistration): Registration method
+        sm_params (SubmapAlignParams): Alignment params
+        use_gt_i (bool): Use ground truth pose of submap_i to compute the correct T_ij
+        use_gt_j (bool): Use ground truth pose of submap_j to compute the correct T_ij
+        skip_registration (bool, optional): Record the pair as having no loop closure without 
+            registering. Defaults to False.
+
+    Returns:
+        tuple: robots nearby distance, submap yaw difference, angle error, distance error, 
+            number of associations, percent of associations, T_ij, T_ij_hat, associations, 
+            and registration time (None if registration was skipped)
+    """
+    robots_nearby = np.nan
+    submap_yaw_diff = np.nan
+    if submap_i.has_gt and submap_j.has_gt:
+        submap_distance = norm(submap_i.position_gt - submap_j.position_gt)
+    else:
+        submap_distance = norm(submap_i.position - submap_j.position)
+    if submap_distance < sm_params.submap_radius*2:
+        robots_nearby = submap_distance
+
+    segments_i = submap_i.segments
+    segments_j = submap_j.segments
+    if sm_params.single_robot_lc: # self loop closures
+        # exclude segments that are in both submaps
+        keep_i = ~np.isin(ids_i, ids_j)
+        keep_j = ~np.isin(ids_j, ids_i)
+        segments_i = [seg for seg, keep in zip(segments_i, keep_i) if keep]
+        segments_j = [seg for seg, keep in zip(segments_j, keep_j) if keep]
+        features_i = features_i[keep_i]
+        features_j = features_j[keep_j]
+
+    # determine correct T_ij
+    if use_gt_i:
+        T_wi = submap_i.pose_gravity_aligned_gt
+    else:
+        T_wi = submap_i.pose_gravity_aligned
+    if use_gt_j:
+        T_wj = submap_j.pose_gravity_aligned_gt
+    else:
+        T_wj = submap_j.pose_gravity_aligned
+    T_ij = np.linalg.inv(T_wi) @ T_wj
+    if not np.isnan(robots_nearby):
+        relative_yaw_angle = transform_to_xyzrpy(T_ij)[5]
+        submap_yaw_diff = np.abs(np.rad2deg(relative_yaw_angle))
+        
+    # register the submaps
+    try:
+        start_t = time.time()
+        if skip_registration:
+            raise InsufficientAssociationsException(len(segments_i), len(segments_j), 0)
+        associations = registration.register(segments_i, segments_j, features_i, features_j)
+        registration_time = time.time() - start_t
+        
+        if sm_params.dim == 2:
+            T_ij_hat = registration.T_align(segments_i, segments_j, associations)
+            T_error = np.linalg.inv(T_ij_hat) @ T_ij
+            _, _, theta = transform_to_xytheta(T_error)
+            dist = np.linalg.norm(T_error[:sm_params.dim, 3])
+
+        elif sm_params.dim == 3:
+            T_ij_hat = registration.T_align(segments_i, segments_j, associations)
+            if sm_params.force_rm_upside_down:
+                xyzrpy = transform_to_xyzrpy(T_ij_hat)
+                if np.abs(xyzrpy[3]) > np.deg2rad(90.) or np.abs(xyzrpy[4]) > np.deg2rad(90.):
+                    raise GravityConstraintError
+            if sm_params.force_rm_lc_roll_pitch:
+                T_ij_hat = transform_rm_roll_pitch(T_ij_hat)
+            T_error = np.linalg.inv(T_ij_hat) @ T_ij
+            theta = Rot.from_matrix(T_error[:3, :3]).magnitude()
+            dist = np.linalg.norm(T_error[:sm_params.dim, 3])
+        else:
+            raise ValueError("Invalid dimension")
+        
+    except (InsufficientAssociationsException, GravityConstraintError) as ex:
+        registration_time = time.time() - start_t if not skip_registration else None
+        T_ij_hat = np.zeros((4, 4))*np.nan
+        theta = 180.0
+        dist = 1e6
+        associations = []
+    
+    if not np.isnan(robots_nearby):
+        angle_error = np.abs(np.rad2deg(theta))
+        dist_error = dist
+    else:
+        angle_error = np.nan
+        dist_error = np.nan
+
+    num_associations = len(associations)
+    percent_associations = len(associations) / np.mean([len(segments_i), len(segments_j)])
+    
+    return robots_nearby, submap_yaw_diff, angle_error, dist_error, num_associations, \
+        percent_associations, T_ij, T_ij_hat, associations, registration_time
+
+# per-process state for parallel alignment
+_worker_state = dict()
+
+def _init_align_worker(submaps: List[List[Submap]], segment_ids: List[List[np.ndarray]], 
+                       features: List[List[np.ndarray]], skip_mat: np.ndarray, 
+                       sm_params: SubmapAlignParams, use_gt_i: bool, use_gt_j: bool):
+    _worker_state['submaps'] = submaps
+    _worker_state['segment_ids'] = segment_ids
+    _worker_state['features'] = features
+    _worker_state['skip_mat'] = skip_mat
+    _worker_state['sm_params'] = sm_params
+    _worker_state['use_gt'] = (use_gt_i, use_gt_j)
+    _worker_state['registration'] = sm_params.get_object_registration()
+
+def _align_worker_row(i: int):
+    submaps = _worker_state['submaps']
+    segment_ids = _worker_state['segment_ids']
+    features = _worker_state['features']
+    return [_align_submap_pair(submaps[0][i], submaps[1][j], segment_ids[0][i], 
+                               segment_ids[1][j], features[0][i], features[1][j], 
+                               _worker_state['registration'], 
+                               _worker_state['sm_params'], *_worker_state['use_gt'],
+                               skip_registration=_worker_state['skip_mat'][i, j])
+            for j in range(len(submaps[1]))]
@@ -15,7 +15,6 @@
 import cv2 as cv
 import numpy as np
 import open3d as o3d
-import copy
 import torch
 from yolov7_package import Yolov7Detector
 import math
@@ -138,6 +137,7 @@ class FastSAMWrapper():
             allow_tblr_edges=[True, True, True, True],
             area_bounds=[img_area / (params.min_mask_len_div**2), img_area / (params.max_mask_len_div**2)],
             clip_embedding=params.clip,
+            clip_batch_size=params.clip_batch_size,
             triangle_ignore_masks=params.triangle_ignore_masks
         )
 
@@ -154,6 +154,7 @@ class FastSAMWrapper():
         keep_mask_minimal_intersection=0.3,
         clip_embedding=False,
         clip_model='ViT-L/14',
+        clip_batch_size=32,
         triangle_ignore_masks=None
     ):
         """
@@ -168,6 +169,7 @@ class FastSAMWrapper():
             area_bounds (np.array, shape=(2,), optional): Two element array indicating min and max number of pixels. Defaults to np.array([0, np.inf]).
             allow_tblr_edges (list, optional): Allow masks touching top, bottom, left, and right edge. Defaults to [True, True, True, True].
             keep_mask_minimal_intersection (float, optional): Minimal intersection of mask within keep mask to be kept. Defaults to 0.3.
+            clip_batch_size (int, optional): Max number of mask crops encoded by CLIP in one forward pass. Defaults to 32.
         """
         assert not use_keep_labels or keep_labels_option == 'intersect' or keep_labels_option == 'contain', "Keep labels option should be one of: intersect, contain"
         self.ignore_labels = ignore_labels
@@ -184,6 +186,7 @@ class FastSAMWrapper():
         self.keep_mask_minimal_intersection = keep_mask_minimal_intersection
         self.run_yolo = len(ignore_labels) > 0 or use_keep_labels
         self.clip_embedding = clip_embedding
+        self.clip_batch_size = clip_batch_size
         if clip_embedding:
             self.clip_model, self.clip_preprocess = clip.load(clip_model, device=self.device)
         if triangle_ignore_masks is not None:
@@ -234,6 +237,9 @@ class FastSAMWrapper():
         )
         self.voxel_size = voxel_size
         self.pcd_stride = pcd_stride
+        # pixel offsets from the principal point of the strided depth image, used to 
+        # back-project the whole depth image at once. Cached by depth image shape.
+        self._depth_pixel_offsets = dict()
         if erosion_size > 0:
             # see: https://docs.opencv.org/3.4/db/df6/tutorial_erosion_dilatation.html
             erosion_shape = cv.MORPH_ELLIPSE
@@ -272,6 +278,15 @@ class FastSAMWrapper():
         
         # run fastsam
         masks = self._process_img(img, ignore_mask=ignore_mask, keep_mask=keep_mask)
+
+        # back-project the depth image once for all masks
+        if img_depth is not None:
+            logger.debug(f"img_depth type {img_depth.dtype}, shape={img_depth.shape}")
+            depth_points = self._backproject_depth(img_depth)
+
+        # CLIP inputs are collected and encoded together after all masks are processed
+        clip_inputs = []
+        clip_observations = []
         
         for mask in masks:
             
@@ -280,40 +295,20 @@ class FastSAMWrapper():
             # Extract point cloud of object from RGBD
             ptcld = None
             if img_depth is not None:
-                depth_obj = copy.deepcopy(img_depth)
                 if self.erosion_element is not None:
-                    eroded_mask = cv.erode(mask, self.erosion_element)
-                    depth_obj[eroded_mask==0] = 0
+                    mask_obj = cv.erode(mask, self.erosion_element)
                 else:
-                    depth_obj[mask==0] = 0
-                logger.debug(f"img_depth type {img_depth.dtype}, shape={img_depth.shape}")
-
-                # Extract point cloud without truncation to heuristically check if enough of the object
-                # is within the max depth
-                pcd_test = o3d.geometry.PointCloud.create_from_depth_image(
-                    o3d.geometry.Image(np.ascontiguousarray(depth_obj).astype(np.uint16)),
-                    self.depth_cam_intrinsics,
-                    depth_scale=self.depth_scale,
-                    # depth_trunc=self.max_depth,
-                    stride=self.pcd_stride,
-                    project_valid_depth_only=True
-                )
-                ptcld_test = np.asarray(pcd_test.points)
-                pre_truncate_len = len(ptcld_test)
-                ptcld_test = ptcld_test[ptcld_test[:,2] < self.max_depth]
+                    mask_obj = mask
+                mask_obj = mask_obj[::self.pcd_stride, ::self.pcd_stride] != 0
+                ptcld_obj = depth_points[mask_obj & (depth_points[:,:,2] > 0)]
+
                 # require some fraction of the points to be within the max depth
-                if len(ptcld_test) < self.within_depth_frac*pre_truncate_len:
+                within_depth = ptcld_obj[:,2] < self.max_depth
+                if np.sum(within_depth) < self.within_depth_frac*len(ptcld_obj):
                     continue
                 
-                pcd = o3d.geometry.PointCloud.create_from_depth_image(
-                    o3d.geometry.Image(np.ascontiguousarray(depth_obj).astype(np.uint16)),
-                    self.depth_cam_intrinsics,
-                    depth_scale=self.depth_scale,
-                    depth_trunc=self.max_depth,
-                    stride=self.pcd_stride,
-                    project_valid_depth_only=True
-                )
-                pcd.remove_non_finite_points()
+                pcd = o3d.geometry.PointCloud()
+                pcd.points = o3d.utility.Vector3dVector(ptcld_obj[within_depth])
                 pcd_sampled = pcd.voxel_down_sample(voxel_size=self.voxel_size)
                 if not pcd_sampled.is_empty():
                     ptcld = np.asarray(pcd_sampled.points)
@@ -359,16 +354,67 @@ class FastSAMWrapper():
                     min_col, min_row, max_col, max_row = bbox
                     img_bbox = self.apply_rotation(img_orig[min_row:max_row, min_col:max_col])
                     img_bbox = cv.cvtColor(img_bbox, cv.COLOR_BGR2RGB)
-                    processed_img = self.clip_preprocess(Image.fromarray(img_bbox, mode='RGB')).to(self.device)
-                    clip_embedding = self.clip_model.encode_image(processed_img.unsqueeze(dim=0))
-                    clip_embedding = clip_embedding.squeeze().cpu().detach().numpy()
-                    self.observations.append(Observation(t, pose, mask, mask_downsampled, ptcld, clip_embedding=clip_embedding))
+                    clip_inputs.append(self.clip_preprocess(Image.fromarray(img_bbox, mode='RGB')))
+                    clip_observations.append(Observation(t, pose, mask, mask_downsampled, ptcld))
+                    self.observations.append(clip_observations[-1])
                 
             else:
                 self.observations.append(Observation(t, pose, mask, mask_downsampled, ptcld))
+
+        if len(clip_inputs) > 0:
+            for obs, clip_embedding in zip(clip_observations, self._encode_clip(clip_inputs)):
+                obs.clip_embedding = clip_embedding
                 
         return self.observations
     
+    def _encode_clip(self, processed_imgs):
+        """
+        Encodes preprocessed images with CLIP in batches of at most clip_batch_size.
+
+        Args:
+            processed_imgs (List[torch.Tensor]): images from clip_preprocess
+
+        Returns:
+            (n, d) np.array: CLIP embeddings in the same order as the images
+        """
+        clip_embeddings = []
+        with torch.no_grad():
+            for i in range(0, len(processed_imgs), self.clip_batch_size):
+                batch = torch.stack(processed_imgs[i:i+self.clip_batch_size]).to(self.device)
+                clip_embeddings.append(self.clip_model.encode_image(batch).cpu().numpy())
+        return np.concatenate(clip_embeddings, axis=0)
+    
+    def _backproject_depth(self, img_depth):
+        """
+        Back-projects every pcd_stride-th pixel of a depth image into the camera frame, matching 
+        o3d.geometry.PointCloud.create_from_depth_image.
+
+        Args:
+            img_depth ((h,w) np.array): depth image
+
+        Returns:
+            (h/pcd_stride, w/pcd_stride, 3) np.array: xyz of each strided pixel, with z = 0 for 
+                pixels without a valid depth
+        """
+        depth = np.ascontiguousarray(img_depth).astype(np.uint16)[::self.pcd_stride, ::self.pcd_stride]
+        # open3d converts depth to float32 before back-projecting
+        z = (depth.astype(np.float32) / np.float32(self.depth_scale)).astype(np.float64)
+        offsets_x, offsets_y = self._pixel_offsets(np.shape(img_depth)[:2])
+        return np.stack([
+            offsets_x * z / self.depth_cam_params.fx,
+            offsets_y * z / self.depth_cam_params.fy,
+            z
+        ], axis=2)
+    
+    def _pixel_offsets(self, shape):
+        if shape not in self._depth_pixel_offsets:
+            height, width = shape
+            self._depth_pixel_offsets[shape] = (
+                np.arange(0, width, self.pcd_stride)[None,:] - self.depth_cam_params.cx,
+                np.arange(0, height, self.pcd_stride)[:,None] - self.depth_cam_params.cy
+            )
+        return self._depth_pixel_offsets[shape]
+    
     def apply_rotation(self, img, unrotate=False):
         if self.rotate_img is None:
             result = img
@@ -434,15 +480,31 @@ class FastSAMWrapper():
         return ignore_mask, keep_mask
 
     def _delete_edge_masks(self, segmask):
-        [numMasks, h, w] = segmask.shape
-        contains_edge = np.zeros(numMasks).astype(np.bool_)
-        for i in range(numMasks):
-            mask = segmask[i,:,:]
-            edge_width = 5
-            # TODO: should be a parameter
-            contains_edge[i] = (np.sum(mask[:,:edge_width]) > 0 and not self.allow_tblr_edges[2]) or (np.sum(mask[:,-edge_width:]) > 0 and not self.allow_tblr_edges[3]) or \
-                            (np.sum(mask[:edge_width,:]) > 0 and not self.allow_tblr_edges[0]) or (np.sum(mask[-edge_width:, :]) > 0 and not self.allow_tblr_edges[1])
-        return np.delete(segmask, contains_edge, axis=0)
+        return segmask[~self._edge_masks(segmask)]
+    
+    def _edge_masks(self, segmask):
+        """
+        Finds the masks touching a disallowed image edge.
+
+        Args:
+            segmask ((n,h,w) torch.Tensor or np.array): segmentation masks
+
+        Returns:
+            (n,) bool torch.Tensor or np.array: True for masks touching a disallowed edge
+        """
+        edge_width = 5
+        # TODO: should be a parameter
+        numMasks = segmask.shape[0]
+        tblr_strips = [segmask[:,:edge_width,:], segmask[:,-edge_width:,:], 
+                       segmask[:,:,:edge_width], segmask[:,:,-edge_width:]]
+        if isinstance(segmask, torch.Tensor):
+            contains_edge = torch.zeros(numMasks, dtype=torch.bool, device=segmask.device)
+        else:
+            contains_edge = np.zeros(numMasks, dtype=bool)
+        for strip, allowed in zip(tblr_strips, self.allow_tblr_edges):
+            if not allowed:
+                contains_edge = contains_edge | (strip.reshape(numMasks, -1).sum(1) > 0)
+        return contains_edge
 
     def _process_img(self, image_bgr, ignore_mask=None, keep_mask=None):
         """Process FastSAM on image, returns segment masks and center points from results
@@ -474,52 +536,34 @@ class FastSAMWrapper():
         prompt_process = FastSAMPrompt(image, everything_results, device=self.device)
         segmask = prompt_process.everything_prompt()
 
-        # If there were segmentations detected by FastSAM, transfer them from GPU to CPU and convert to Numpy arrays
-        if (len(segmask) > 0):
-            segmask = segmask.cpu().numpy()
-        else:
-            segmask = None
-
-        if (segmask is not None):
-            # FastSAM provides a numMask-channel image in shape C, H, W where each channel in the image is a binary mask
-            # of the detected segment
-            [numMasks, h, w] = segmask.shape
-
-            # filter out edge-touching segments
-            # could do with multi-dimensional summing faster instead of looping over masks
-            if not np.all(self.allow_tblr_edges):
-                segmask = self._delete_edge_masks(segmask)
-                [numMasks, h, w] = segmask.shape
-
-            to_delete = []
-            for maskId in range(numMasks):
-                # Extract the single binary mask for this mask id
-                mask_this_id = segmask[maskId,:,:]
-
-                # filter out ignore mask
-                if ignore_mask is not None and np.any(np.bitwise_and(mask_this_id.astype(np.int8), ignore_mask)):
-                    to_delete.append(maskId)
-                    continue
+        if len(segmask) == 0:
+            return []
 
-                # Only keep masks that are within keep_mask
-                # if keep_mask is not None and not np.any(np.bitwise_and(mask_this_id.astype(np.int8), keep_mask)):
-                #     print("Delete maskID: ", maskId)
-                #     to_delete.append(maskId)
-                #     continue
-                # if keep_mask is not None and self.keep_labels_option == 'intersect' and (not np.any(np.bitwise_and(mask_this_id.astype(np.int8), keep_mask))):
-                if keep_mask is not None and self.keep_labels_option == 'intersect' and (np.bitwise_and(mask_this_id.astype(np.int8), keep_mask).sum() < self.keep_mask_minimal_intersection*mask_this_id.astype(np.int8).sum()):
-                    to_delete.append(maskId)
-                    continue
+        # FastSAM provides a numMask-channel image in shape C, H, W where each channel in the image is a binary mask
+        # of the detected segment. All masks are filtered at once on the FastSAM device and only the masks that 
+        # are kept are transferred to the CPU
+        numMasks = segmask.shape[0]
+        masks_flat = segmask.reshape(numMasks, -1).to(torch.float32)
+        areas = masks_flat.sum(dim=1)
+        keep = torch.ones(numMasks, dtype=torch.bool, device=segmask.device)
 
-                if self.area_bounds is not None:
-                    area = np.sum(mask_this_id)
-                    if area < self.area_bounds[0] or area > self.area_bounds[1]:
-                        to_delete.append(maskId)
-                        continue
+        # filter out edge-touching segments
+        if not np.all(self.allow_tblr_edges):
+            keep &= ~self._edge_masks(segmask)
 
-            segmask = np.delete(segmask, to_delete, axis=0)
+        # filter out ignore mask
+        if ignore_mask is not None:
+            ignore_flat = torch.as_tensor(ignore_mask != 0, device=segmask.device).reshape(-1).to(torch.float32)
+            keep &= ~(masks_flat @ ignore_flat > 0)
 
-        else: 
-            return []
+        # Only keep masks that are within keep_mask
+        if keep_mask is not None and self.keep_labels_option == 'intersect':
+            keep_flat = torch.as_tensor(keep_mask != 0, device=segmask.device).reshape(-1).to(torch.float32)
+            keep &= ~(masks_flat @ keep_flat < self.keep_mask_minimal_intersection*areas)
+
+        if self.area_bounds is not None:
+            keep &= (areas >= self.area_bounds[0]) & (areas <= self.area_bounds[1])
+
+        segmask = segmask[keep].cpu().numpy()
 
         return segmask
\ No newline at end of file
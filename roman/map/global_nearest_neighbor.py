@@ -1,7 +1,11 @@
 import numpy as np
 from scipy.optimize import linear_sum_assignment
 
-def global_nearest_neighbor(data1: list, data2: list, similarity_fun: callable, min_similarity: float = None):
+from roman.utils import UnionFind
+
+def global_nearest_neighbor(data1: list, data2: list, similarity_fun: callable, min_similarity: float = None,
+                            candidates: np.ndarray = None, sparse: bool = False, 
+                            similarities: np.ndarray = None):
     """
     Associates data1 with data2 using the global nearest neighbor algorithm.
 
@@ -10,17 +14,35 @@ def global_nearest_neighbor(data1: list, data2: list, similarity_fun: callable,
         data2 (list): List of second data items
         similarity_fun (callable(item1, item2)): Evaluates the similarity between two items
         min_similarity (float): Minimum similarity required to associate two items
+        candidates (np.ndarray, shape=(len(data1), len(data2)), optional): Boolean mask of the 
+            pairs that could be associated. similarity_fun is only evaluated for candidate pairs, 
+            all other pairs are given the no association cost. Defaults to None (all pairs are 
+            candidates).
+        sparse (bool, optional): If true, only feasible pairs are kept and each connected 
+            component of the bipartite association graph is solved separately. Gives the same 
+            associations as the dense solver up to tie-breaking between equal-cost assignments. 
+            Defaults to False.
+        similarities (np.ndarray, shape=(len(data1), len(data2)), optional): Precomputed 
+            similarity matrix. If given, similarity_fun is not called and only the candidate 
+            entries of the matrix are used. Defaults to None.
 
     Returns:
         list of pairs (data1, data2) indicies that should be associated together
     """
     len1 = len(data1)
     len2 = len(data2)
-    scores = np.zeros((len1, len2))
     M = 1e9 # just a large number
+    scores = np.ones((len1, len2))*M
+    if candidates is None:
+        candidates = np.ones((len1, len2), dtype=bool)
+    assert candidates.shape == (len1, len2), "candidates must be a len(data1) x len(data2) mask"
 
-    for i in range(len1):
-        for j in range(len2):
+    if similarities is not None:
+        assert similarities.shape == (len1, len2), "similarities must be a len(data1) x len(data2) matrix"
+        feasible = candidates if min_similarity is None else candidates & ~(similarities < min_similarity)
+        scores[feasible] = -similarities[feasible]
+    else:
+        for i, j in zip(*np.nonzero(candidates)):
             similarity = similarity_fun(data1[i], data2[j])
             
             # Geometry similarity value
@@ -30,6 +52,16 @@ def global_nearest_neighbor(data1: list, data2: list, similarity_fun: callable,
                 score = -similarity
             scores[i,j] = score # TODO: Hungarian is trying to associate low similarity values, score should maybe = - similarity....
 
+    if sparse:
+        return _sparse_assignment(scores, M)
+    return _augmented_assignment(scores)
+
+def _augmented_assignment(scores: np.ndarray):
+    """
+    Solves the assignment problem with an added option for each item to not be associated.
+    """
+    len1, len2 = scores.shape
+
     # augment cost to add option for no associations
     hungarian_cost = np.concatenate([
         np.concatenate([scores, np.ones(scores.shape)], axis=1),
@@ -43,4 +75,45 @@ def global_nearest_neighbor(data1: list, data2: list, similarity_fun: callable,
             assert scores[idx1,idx2] <= 1
             pairs.append((idx1, idx2))
 
-    return pairs
\ No newline at end of file
+    return pairs
+
+def _sparse_assignment(scores: np.ndarray, M: float):
+    """
+    Solves the same problem as _augmented_assignment, but only over feasible (score < M) pairs.
+    Since leaving an item unassociated costs the same regardless of the rest of the assignment, 
+    each connected component of the feasible bipartite graph can be solved independently.
+    The total cost is the same as _augmented_assignment, but when several assignments have 
+    equal cost a different one may be chosen.
+    """
+    len1, len2 = scores.shape
+    rows, cols = np.nonzero(scores < M)
+    if len(rows) == 0:
+        return []
+
+    # group feasible pairs by connected component of the bipartite graph with nodes 
+    # [data1 items, data2 items]
+    components = UnionFind(len1 + len2)
+    for row, col in zip(rows.tolist(), cols.tolist()):
+        components.union(row, len1 + col)
+    component_edges = dict()
+    for row, col in zip(rows.tolist(), cols.tolist()):
+        comp_rows, comp_cols = component_edges.setdefault(components.find(row), (set(), set()))
+        comp_rows.add(row)
+        comp_cols.add(col)
+
+    pairs = []
+    for comp_rows, comp_cols in component_edges.values():
+        comp_rows = sorted(comp_rows)
+        comp_cols = sorted(comp_cols)
+
+        # associating is always cheaper than not associating, so if one side of the 
+        # component has a single item, it is associated with its best match
+        if len(comp_rows) == 1:
+            pairs.append((comp_rows[0], min(comp_cols, key=lambda col: scores[comp_rows[0], col])))
+        elif len(comp_cols) == 1:
+            pairs.append((min(comp_rows, key=lambda row: scores[row, comp_cols[0]]), comp_cols[0]))
+        else:
+            comp_pairs = _augmented_assignment(scores[np.ix_(comp_rows, comp_cols)])
+            pairs += [(comp_rows[idx1], comp_cols[idx2]) for idx1, idx2 in comp_pairs]
+
+    return sorted(pairs)
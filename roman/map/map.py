@@ -1,18 +1,19 @@
 import numpy as np
 from numpy.linalg import norm
 from scipy.spatial.transform import Rotation as Rot
+from scipy.spatial import cKDTree
 
 import os
 import pickle
-from copy import deepcopy
+from copy import copy, deepcopy
 from dataclasses import dataclass
-from typing import List
+from typing import List, Iterable
 import json
 
 from robotdatapy.data.pose_data import PoseData
 
 from roman.params.submap_align_params import SubmapAlignParams
-from roman.object.segment import Segment, SegmentMinimalData
+from roman.object.segment import Segment, SegmentMinimalData, SegmentView
 from roman.utils import transform_rm_roll_pitch
 
 @dataclass(frozen=True)
@@ -39,10 +40,54 @@ class ROMANMap:
         )
         
     def get_segment_by_id(self, seg_id) -> Segment:
-        for seg in self.segments:
-            if seg.id == seg_id:
-                return seg
-        return None
+        """
+        Returns the segment with id seg_id, or None if there is no such segment.
+        """
+        return self.get_segments_by_ids([seg_id])[0]
+    
+    def get_segments_by_ids(self, seg_ids: Iterable[int]) -> List[Segment]:
+        """
+        Looks up the segments with the given ids using an id to index map that is built on first 
+        use. If an id is missing from the map or its segment has a different id, the segments 
+        may have changed since the map was built, so it is rebuilt once.
+
+        Args:
+            seg_ids (Iterable[int]): Segment ids
+
+        Returns:
+            List[Segment]: Segments in the same order as seg_ids, None for ids with no segment
+        """
+        seg_ids = list(seg_ids)
+        indices = [self._segment_index().get(seg_id) for seg_id in seg_ids]
+        if not all(self._index_is_valid(idx, seg_id) for idx, seg_id in zip(indices, seg_ids)):
+            self.invalidate_segment_index()
+            indices = [self._segment_index().get(seg_id) for seg_id in seg_ids]
+        return [self.segments[idx] if idx is not None else None for idx in indices]
+    
+    def invalidate_segment_index(self):
+        """
+        Clears the segment id to index map so that it is rebuilt on the next lookup.
+        """
+        self.__dict__.pop('_segment_index_map', None)
+    
+    def _segment_index(self) -> dict:
+        if '_segment_index_map' not in self.__dict__:
+            index = dict()
+            for i, seg in enumerate(self.segments):
+                index.setdefault(seg.id, i) # first segment with an id, as in a linear scan
+            # frozen dataclass, the index is a cache rather than a field
+            object.__setattr__(self, '_segment_index_map', index)
+        return self.__dict__['_segment_index_map']
+    
+    def _index_is_valid(self, idx: int, seg_id: int) -> bool:
+        # ids missing from the index may belong to segments changed since it was built
+        return idx is not None and idx < len(self.segments) and self.segments[idx].id == seg_id
+    
+    def __getstate__(self):
+        # the segment index is a cache and is rebuilt after unpickling
+        state = self.__dict__.copy()
+        state.pop('_segment_index_map', None)
+        return state
     
     def make_picklable(self):
         for seg in self.segments:
@@ -65,30 +110,188 @@ class ROMANMap:
                     times=times
                 )
         return roman_map
+    
+    def to_columnar(self, path: str):
+        """
+        Saves the map as a directory of .npy files that can be memory-mapped by from_columnar. 
+        The points of all segments are stored in one concatenated array with per-segment offsets 
+        and every other segment attribute is stored in its own array. The per-segment arrays 
+        hold everything in the segments' minimal data, so they can be loaded without the points.
+
+        Args:
+            path (str): Output directory
+        """
+        path = os.path.expanduser(path)
+        os.makedirs(path, exist_ok=True)
         
+        points = [getattr(seg, 'points', None) for seg in self.segments]
+        points = [np.zeros((0,3)) if pts is None else np.asarray(pts).reshape((-1,3)) 
+                  for pts in points]
+        centers, bottom_middle_centers = [], []
+        for seg, pts in zip(self.segments, points):
+            # the centers column holds the mean regardless of the center reference point
+            assert seg.mean is not None, f"Mean of segment {seg.id} is not known"
+            centers.append(np.reshape(seg.mean, -1))
+            if len(pts) > 0:
+                bottom_middle = np.median(pts, axis=0)
+                bottom_middle[2] = np.min(pts[:,2])
+            elif seg._center_ref == 'bottom_middle':
+                bottom_middle = np.reshape(seg.center, -1)
+            else:
+                bottom_middle = centers[-1]
+            bottom_middle_centers.append(bottom_middle)
+        shape_attributes = []
+        for seg in self.segments:
+            e = seg.normalized_eigenvalues()
+            shape_attributes.append([seg.volume, seg.linearity(e), seg.planarity(e), 
+                                     seg.scattering(e)])
+        descriptors = [seg.semantic_descriptor for seg in self.segments]
+        descriptor_dim = max([np.size(d) for d in descriptors if d is not None], default=0)
+        has_descriptor = np.array([d is not None for d in descriptors], dtype=bool)
+        descriptors = np.array([np.zeros(descriptor_dim) if d is None else np.reshape(d, -1) 
+                                for d in descriptors], dtype=np.float64)
+        
+        columns = {
+            'ids': np.array([seg.id for seg in self.segments], dtype=np.int64),
+            'points': np.concatenate(points + [np.zeros((0,3))], axis=0).astype(np.float64),
+            'point_offsets': np.concatenate([[0], np.cumsum([len(pts) for pts in points])])
+                .astype(np.int64),
+            'centers': np.array(centers, dtype=np.float64).reshape((-1,3)),
+            'bottom_middle_centers': np.array(bottom_middle_centers, dtype=np.float64)
+                .reshape((-1,3)),
+            'shape_attributes': np.array(shape_attributes, dtype=np.float64).reshape((-1,4)),
+            'extents': np.array([np.zeros(3) if seg.extent is None else seg.extent 
+                                 for seg in self.segments], dtype=np.float64).reshape((-1,3)),
+            'semantic_descriptors': descriptors.reshape((len(self.segments), descriptor_dim)),
+            'has_semantic_descriptor': has_descriptor,
+            'first_seen': np.array([seg.first_seen for seg in self.segments], dtype=np.float64),
+            'last_seen': np.array([seg.last_seen for seg in self.segments], dtype=np.float64),
+            'trajectory': np.array(self.trajectory, dtype=np.float64).reshape((-1,4,4)),
+            'times': np.array(self.times, dtype=np.float64),
+            'poses_are_flu': np.array(self.poses_are_flu)
+        }
+        for name, column in columns.items():
+            np.save(os.path.join(path, f"{name}.npy"), column)
+    
     @classmethod
-    def concatenate(cls, roman_maps: list):
-        reference = roman_maps[0]
-        if len(roman_maps) == 1:
-            return reference
-        elif len(roman_maps) == 2:
-            other = deepcopy(roman_maps[1])
-            assert reference.poses_are_flu == other.poses_are_flu
-            max_seg_id = max([seg.id for seg in reference.segments])
-            for segment in other.segments:
-                segment.id += max_seg_id
-            return cls(
-                segments=reference.segments + other.segments,
-                trajectory=reference.trajectory + other.trajectory,
-                times=reference.times + other.times,
-                poses_are_flu=reference.poses_are_flu
+    def from_columnar(cls, path: str, mmap_mode: str = 'r', minimal_data: bool = False, 
+                      center_ref: str = 'mean'):
+        """
+        Loads a map saved with to_columnar. Segments are SegmentView objects, which only read 
+        their points from the concatenated point array when accessed.
+
+        Args:
+            path (str): Directory written by to_columnar
+            mmap_mode (str, optional): Memory-map mode passed to np.load. None reads the arrays 
+                into memory. Defaults to 'r'.
+            minimal_data (bool, optional): If True, only the minimal data table is loaded and 
+                segments are SegmentMinimalData objects. Points are not opened. Defaults to False.
+            center_ref (str, optional): Segment center reference point, 'mean' or 
+                'bottom_middle'. Defaults to 'mean'.
+
+        Returns:
+            ROMANMap: map
+        """
+        assert center_ref in ['mean', 'bottom_middle']
+        path = os.path.expanduser(path)
+        load = lambda name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+
+        # small per-segment arrays are read into memory, larger arrays stay memory-mapped
+        ids = np.array(load('ids'))
+        centers = np.array(load('centers'))
+        bottom_middle_centers = np.array(load('bottom_middle_centers'))
+        shape_attributes = np.array(load('shape_attributes'))
+        extents = np.array(load('extents'))
+        has_descriptor = np.array(load('has_semantic_descriptor'))
+        first_seen = np.array(load('first_seen'))
+        last_seen = np.array(load('last_seen'))
+        descriptors = load('semantic_descriptors')
+        if minimal_data:
+            descriptors = np.array(descriptors)
+        else:
+            points = load('points')
+            point_offsets = np.array(load('point_offsets'))
+
+        segments = []
+        for i in range(len(ids)):
+            minimal_data_args = dict(
+                id=ids[i].item(),
+                center=centers[i],
+                volume=shape_attributes[i,0].item(),
+                linearity=shape_attributes[i,1].item(),
+                planarity=shape_attributes[i,2].item(),
+                scattering=shape_attributes[i,3].item(),
+                extent=extents[i],
+                semantic_descriptor=descriptors[i] if has_descriptor[i] else None,
+                first_seen=first_seen[i].item(),
+                last_seen=last_seen[i].item()
             )
+            if minimal_data:
+                if center_ref == 'bottom_middle':
+                    minimal_data_args['center'] = bottom_middle_centers[i]
+                    minimal_data_args['mean'] = centers[i]
+                segments.append(SegmentMinimalData(**minimal_data_args, center_ref=center_ref))
+            else:
+                segments.append(SegmentView(
+                    **minimal_data_args,
+                    bottom_middle_center=bottom_middle_centers[i],
+                    all_points=points,
+                    point_start=point_offsets[i].item(),
+                    point_end=point_offsets[i+1].item()
+                ))
+                segments[-1].set_center_ref(center_ref)
         
-        else:
-            while len(roman_maps) > 1:
-                concatenated = cls.concatenate(roman_maps[:2])
-                roman_maps = [concatenated]  + roman_maps[2:]
-            return concatenated
+        return cls(
+            segments=segments,
+            trajectory=list(np.array(load('trajectory'))),
+            times=np.array(load('times')).tolist(),
+            poses_are_flu=bool(load('poses_are_flu'))
+        )
+        
+    @classmethod
+    def concatenate(cls, roman_maps: Iterable['ROMANMap'], deep_copy: bool = True):
+        """
+        Concatenates maps in a single pass. Segment ids of each map are offset to come after 
+        the ids of the previous maps. Maps are used one at a time, so roman_maps can be a 
+        generator that loads each map from disk.
+
+        Args:
+            roman_maps (Iterable[ROMANMap]): Maps to concatenate
+            deep_copy (bool, optional): If True, segments are deep copied. Otherwise, the 
+                concatenated map shares segments with the input maps and their ids are changed 
+                in place, which avoids the copy when the input maps are not used afterwards. 
+                Defaults to True.
+
+        Returns:
+            ROMANMap: Concatenated map
+        """
+        segments, trajectory, times = [], [], []
+        poses_are_flu = None
+        id_offset = 0
+        for roman_map in roman_maps:
+            if poses_are_flu is None:
+                poses_are_flu = roman_map.poses_are_flu
+            assert roman_map.poses_are_flu == poses_are_flu
+            
+            map_segments = deepcopy(roman_map.segments) if deep_copy else roman_map.segments
+            if not deep_copy:
+                roman_map.invalidate_segment_index()
+            for segment in map_segments:
+                segment.id += id_offset
+            if len(map_segments) > 0:
+                id_offset = max(id_offset, max([seg.id for seg in map_segments]) + 1)
+            
+            segments += map_segments
+            trajectory += list(roman_map.trajectory)
+            times += list(roman_map.times)
+        assert poses_are_flu is not None, "No maps to concatenate"
+        
+        return cls(
+            segments=segments,
+            trajectory=trajectory,
+            times=times,
+            poses_are_flu=poses_are_flu
+        )
 
 @dataclass
 class Submap:
@@ -142,16 +345,23 @@ class SubmapParams:
             time_threshold=submap_align_params.submap_center_time,
         )
 
-def load_roman_map(map_file: str) -> ROMANMap:
+def load_roman_map(map_file: str, minimal_data: bool = False, center_ref: str = 'mean') -> ROMANMap:
     """
-    Load a ROMANMap from a pickled file.
+    Load a ROMANMap from a pickled file or a columnar map directory (see ROMANMap.to_columnar).
 
     Args:
-        map_file (str): File path to the pickled ROMANMap
+        map_file (str): File path to the pickled ROMANMap or columnar map directory
+        minimal_data (bool, optional): If True, returns a map of SegmentMinimalData. For columnar 
+            maps, only the minimal data table is loaded. Defaults to False.
+        center_ref (str, optional): Segment center reference point used for minimal data, 
+            'mean' or 'bottom_middle'. Defaults to 'mean'.
 
     Returns:
         ROMANMap: map
     """
+    if os.path.isdir(os.path.expanduser(map_file)):
+        return ROMANMap.from_columnar(map_file, minimal_data=minimal_data, center_ref=center_ref)
+    
     # extract pickled data
     with open(os.path.expanduser(map_file), 'rb') as f:
         pickle_data = pickle.load(f)
@@ -166,6 +376,11 @@ def load_roman_map(map_file: str) -> ROMANMap:
                 trajectory=poses,
                 times=times
             )
+    
+    if minimal_data:
+        for segment in roman_map.segments:
+            segment.set_center_ref(center_ref)
+        roman_map = roman_map.minimal_data()
     return roman_map
 
 def submaps_from_roman_map(roman_map: ROMANMap, submap_params: SubmapParams, 
@@ -202,20 +417,37 @@ def submaps_from_roman_map(roman_map: ROMANMap, submap_params: SubmapParams,
             ))
 
     # add segments to submaps
+    # segment centers and times are stacked once so that each submap's segments can be found with 
+    # a KD-tree radius query and vectorized time constraints
+    if len(roman_map.segments) == 0:
+        return submaps
+    centers = np.array([seg.center.reshape(-1) for seg in roman_map.segments])
+    first_seen = np.array([seg.first_seen for seg in roman_map.segments])
+    last_seen = np.array([seg.last_seen for seg in roman_map.segments])
+    submap_times = np.array([sm.time for sm in submaps])
+    submap_positions = np.array([sm.pose_flu[:3,3] for sm in submaps])
+    nearby_idx = cKDTree(centers).query_ball_point(submap_positions, submap_params.radius)
+
     for i, sm in enumerate(submaps):
         
         # set up timing constraints
-        tm1 = submaps[i-1].time if i > 0 else -np.inf
-        tp1 = submaps[i+1].time if i < len(submaps) - 1 else np.inf
-        meets_time_constraints = lambda seg: not (
-            seg.first_seen > tp1 + submap_params.time_threshold
-            or seg.last_seen < tm1 - submap_params.time_threshold
+        tm1 = submap_times[i-1] if i > 0 else -np.inf
+        tp1 = submap_times[i+1] if i < len(submaps) - 1 else np.inf
+
+        idx = np.sort(np.array(nearby_idx[i], dtype=np.int64))
+        idx = idx[norm(centers[idx] - sm.pose_flu[:3,3], axis=1) < submap_params.radius]
+        meets_time_constraints = ~(
+            (first_seen[idx] > tp1 + submap_params.time_threshold)
+            | (last_seen[idx] < tm1 - submap_params.time_threshold)
         )
+        idx = idx[meets_time_constraints]
 
-        for seg in roman_map.segments:
-            if norm(seg.center.flatten() - sm.pose_flu[:3,3]) < submap_params.radius \
-                    and meets_time_constraints(seg):
-                sm.segments.append(deepcopy(seg))
+        # minimal data segments only store a center that depends on the submap frame, so submaps 
+        # can share all other data with the map's segments
+        if submap_params.use_minimal_data:
+            sm.segments = [copy(roman_map.segments[k]) for k in idx]
+        else:
+            sm.segments = [deepcopy(roman_map.segments[k]) for k in idx]
 
         T_center_odom = np.linalg.inv(sm.pose_gravity_aligned)
         for seg in sm.segments:
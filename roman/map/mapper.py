@@ -21,8 +21,11 @@ from robotdatapy.data.img_data import CameraParams
 from roman.object.segment import Segment
 from roman.map.observation import Observation
 from roman.map.global_nearest_neighbor import global_nearest_neighbor
+from roman.map.spatial_hash import SpatialHashGrid
+from roman.map.voxel_grid import VoxelGrid
 from roman.map.map import ROMANMap
 from roman.params.mapper_params import MapperParams
+from roman.utils import UnionFind
 
 import logging
 logger = logging.getLogger(__name__)
@@ -43,6 +46,7 @@ class Mapper():
         self.poses_flu_history = []
         self.times_history = []
         self._T_camera_flu = np.eye(4)
+        self._segment_index = SpatialHashGrid(self.params.association_cell_size)
 
     def update(self, t: float, pose: np.array, observations: List[Observation]):
 
@@ -57,8 +61,12 @@ class Mapper():
         # associate observations with segments
         # mask_similarity = lambda seg, obs: max(self.mask_similarity(seg, obs, projected=False), 
         #                                        self.mask_similarity(seg, obs, projected=True))
+        segments_to_associate = self.segments + self.segment_nursery
+        candidates = self.association_candidates(segments_to_associate, observations)
         associated_pairs = global_nearest_neighbor(
-            self.segments + self.segment_nursery, observations, self.voxel_grid_similarity, self.params.min_iou
+            segments_to_associate, observations, self.voxel_grid_similarity, self.params.min_iou,
+            candidates=candidates, sparse=True, similarities=self.voxel_grid_similarity_matrix(
+                segments_to_associate, observations, candidates)
         )
 
         # separate segments associated with nursery and normal segments
@@ -135,15 +143,85 @@ class Mapper():
             
         return
     
+    def association_candidates(self, segments: List[Segment], observations: List[Observation]):
+        """
+        Find the segment/observation pairs that could have a nonzero voxel IOU using a spatial 
+        hash grid of segment bounding boxes. The grid is updated incrementally, so only segments 
+        whose bounding boxes changed since the last call are rehashed.
+
+        Args:
+            segments (List[Segment]): Segments to associate
+            observations (List[Observation]): Observations to associate
+
+        Returns:
+            np.ndarray, shape=(len(segments), len(observations)): Boolean mask of candidate pairs
+        """
+        # gating is only exact if pairs with zero IOU can never be associated
+        if self.params.min_iou is None or self.params.min_iou <= 0.0:
+            return None
+
+        # update index with current segment bounding boxes
+        segment_idx = dict()
+        for i, seg in enumerate(segments):
+            aabb = seg.aabb
+            if aabb is None:
+                self._segment_index.remove(seg)
+                continue
+            self._segment_index.update(seg, *aabb)
+            segment_idx[seg] = i
+        for seg in [seg for seg in self._segment_index.keys() if seg not in segment_idx]:
+            self._segment_index.remove(seg)
+
+        # voxel grids only overlap if the segment's bounding box is within one voxel of 
+        # the observation's voxel grid
+        candidates = np.zeros((len(segments), len(observations)), dtype=bool)
+        for j, obs in enumerate(observations):
+            obs_voxel_grid = obs.get_voxel_grid(self.params.iou_voxel_size, 
+                                                self.params.sparse_voxel_grid)
+            for seg in self._segment_index.query(obs_voxel_grid.min_corner, 
+                    obs_voxel_grid.max_corner, margin=self.params.iou_voxel_size):
+                candidates[segment_idx[seg], j] = True
+        logger.debug(f"Association candidates: {np.sum(candidates)} / {candidates.size}")
+        return candidates
+    
     def voxel_grid_similarity(self, segment: Segment, observation: Observation):
         """
         Compute the similarity between the voxel grids of a segment and an observation
         """
         voxel_size = self.params.iou_voxel_size
-        segment_voxel_grid = segment.get_voxel_grid(voxel_size)
-        observation_voxel_grid = observation.get_voxel_grid(voxel_size)
+        sparse = self.params.sparse_voxel_grid
+        segment_voxel_grid = segment.get_voxel_grid(voxel_size, sparse)
+        observation_voxel_grid = observation.get_voxel_grid(voxel_size, sparse)
         return segment_voxel_grid.iou(observation_voxel_grid)
 
+    def voxel_grid_similarity_matrix(self, segments: List[Segment], observations: List[Observation], 
+                                     candidates: np.ndarray = None):
+        """
+        Compute the voxel grid similarity between all segments and observations in one batch
+
+        Args:
+            segments (List[Segment]): Segments
+            observations (List[Observation]): Observations
+            candidates (np.ndarray, shape=(len(segments), len(observations)), optional): Boolean 
+                mask of the pairs that need to be computed. Segments and observations without any 
+                candidate pairs are skipped and given zero similarity. Defaults to None.
+
+        Returns:
+            np.ndarray, shape=(len(segments), len(observations)): Similarity matrix
+        """
+        voxel_size = self.params.iou_voxel_size
+        sparse = self.params.sparse_voxel_grid
+        similarities = np.zeros((len(segments), len(observations)))
+        if candidates is None:
+            candidates = np.ones((len(segments), len(observations)), dtype=bool)
+        seg_idx = np.nonzero(np.any(candidates, axis=1))[0]
+        obs_idx = np.nonzero(np.any(candidates, axis=0))[0]
+        similarities[np.ix_(seg_idx, obs_idx)] = VoxelGrid.iou_matrix(
+            [segments[i].get_voxel_grid(voxel_size, sparse) for i in seg_idx],
+            [observations[j].get_voxel_grid(voxel_size, sparse) for j in obs_idx]
+        )
+        return similarities
+
     def mask_similarity(self, segment: Segment, observation: Observation, projected: bool = False):
         """
         Compute the similarity between the mask of a segment and an observation
@@ -228,7 +306,6 @@ class Mapper():
 
         max_iter = 100
         n = 0
-        edited = True
 
         self.inactive_segments = self.remove_bad_segments(
             self.inactive_segments, 
@@ -237,44 +314,107 @@ class Mapper():
         )
         self.segments = self.remove_bad_segments(self.segments)
 
-        # repeatedly try to merge until no further merges are possible
-        while n < max_iter and edited:
-            edited = False
+        # repeatedly try to merge until no further merges are possible. After the first pass, 
+        # only pairs involving segments that changed in the previous pass need to be checked
+        edited_segments = None
+        while n < max_iter and (edited_segments is None or len(edited_segments) > 0):
             n += 1
-
-            for i, seg1 in enumerate(self.segments):
-                for j, seg2 in enumerate(self.segments + self.inactive_segments):
-                    if i >= j:
+            all_segments = self.segments + self.inactive_segments
+            groups = UnionFind(len(all_segments))
+            for i, j in self.merge_candidates(edited_segments):
+                if self._should_merge(all_segments[i], all_segments[j]):
+                    groups.union(i, j)
+
+            # merge each group into its first segment one member at a time, re-checking each 
+            # member against the grown segment so that chains of pairwise matches are not merged 
+            # transitively. Members that no longer match are retried in the next pass.
+            edited_segments = []
+            to_rm = set()
+            for group in groups.groups():
+                if len(group) == 1: continue
+                seg1 = all_segments[group[0]]
+                for j in group[1:]:
+                    seg2 = all_segments[j]
+                    if not self._should_merge(seg1, seg2):
                         continue
-
-                    # if segments are very far away, don't worry about doing extra checking
-                    if np.mean(seg1.points) - np.mean(seg2.points) > \
-                        .5 * (np.max(seg1.extent) + np.max(seg2.extent)):
-                        continue 
-
-                    maks1 = seg1.reconstruct_mask(self.last_pose)
-                    maks2 = seg2.reconstruct_mask(self.last_pose)
-                    intersection2d = np.logical_and(maks1, maks2).sum()
-                    union2d = np.logical_or(maks1, maks2).sum()
-                    iou2d = intersection2d / union2d
-
-                    iou3d = seg1.get_voxel_grid(self.params.iou_voxel_size).iou(
-                        seg2.get_voxel_grid(self.params.iou_voxel_size))
-
-                    if iou3d > self.params.merge_objects_iou_3d or iou2d > self.params.merge_objects_iou_2d:
-                        seg1.update_from_segment(seg2)
-                        seg1.id = min(seg1.id, seg2.id)
-                        if seg1.num_points == 0:
-                            self.segments.pop(i)
-                        elif j < len(self.segments):
-                            self.segments.pop(j)
-                        else:
-                            self.inactive_segments.pop(j - len(self.segments))
-                        edited = True
+                    seg1.update_from_segment(seg2)
+                    seg1.id = min(seg1.id, seg2.id)
+                    if seg1.num_points == 0:
+                        # only the emptied segment is removed, seg2 is kept
                         break
-                if edited:
-                    break
+                    to_rm.add(id(seg2))
+                if seg1.num_points == 0: to_rm.add(id(seg1))
+                else: edited_segments.append(seg1)
+            self.segments = [seg for seg in self.segments if id(seg) not in to_rm]
+            self.inactive_segments = [seg for seg in self.inactive_segments if id(seg) not in to_rm]
         return
+    
+    def _should_merge(self, seg1: Segment, seg2: Segment) -> bool:
+        """
+        Merge test between two segments: either the 3D IOU of their voxel grids or the IOU of 
+        their reprojected bounding boxes in the last pose must exceed its threshold.
+        """
+        iou3d = seg1.get_voxel_grid(self.params.iou_voxel_size, 
+                                    self.params.sparse_voxel_grid).iou(
+            seg2.get_voxel_grid(self.params.iou_voxel_size, self.params.sparse_voxel_grid))
+        if iou3d > self.params.merge_objects_iou_3d:
+            return True
+        iou2d = seg1.projected_iou(seg2, self.last_pose)
+        return iou2d > self.params.merge_objects_iou_2d
+            
+    def merge_candidates(self, edited_segments: List[Segment] = None) -> List[Tuple[int, int]]:
+        """
+        Find pairs of segments that could be merged. Pairs are indices into 
+        self.segments + self.inactive_segments and always include at least one existing 
+        (not inactive) segment. Segments are paired if their 3D bounding boxes overlap and their 
+        centroids are within half of their summed max extents of each other (3D IOU criterion), 
+        or if their reprojected bounding boxes in the last pose overlap (2D IOU criterion).
+
+        Args:
+            edited_segments (List[Segment], optional): If given, only pairs including one of these 
+                segments are returned. Defaults to None.
+
+        Returns:
+            List[Tuple[int, int]]: Candidate pairs (i, j) with i < j
+        """
+        all_segments = self.segments + self.inactive_segments
+        index = SpatialHashGrid(self.params.association_cell_size)
+        for idx, seg in enumerate(all_segments):
+            if seg.num_points > 0:
+                index.insert(idx, *seg.aabb)
+
+        # 2D IOU can only exceed its threshold if the reprojected bounding boxes overlap
+        use_2d = self.last_pose is not None and self.params.merge_objects_iou_2d < 1.0
+        index_2d = SpatialHashGrid(cell_size=64.0) # pixels
+        if use_2d:
+            for idx, seg in enumerate(all_segments):
+                bbox = seg.reprojected_bbox(self.last_pose) if seg.num_points > 0 else None
+                if bbox is not None:
+                    index_2d.insert(idx, *bbox)
+
+        edited = None if edited_segments is None else \
+            set(id(seg) for seg in edited_segments)
+        
+        candidates = []
+        for i, seg1 in enumerate(self.segments):
+            if i not in index:
+                continue
+            i_edited = edited is None or id(seg1) in edited
+            pairs = set()
+            for j in index.query(*seg1.aabb, margin=self.params.iou_voxel_size):
+                seg2 = all_segments[j]
+                # if segments are very far away, don't worry about doing extra checking
+                if j > i and np.linalg.norm(seg1.mean - seg2.mean) <= \
+                    .5 * (np.max(seg1.extent) + np.max(seg2.extent)):
+                    pairs.add(j)
+            if i in index_2d:
+                pairs.update(j for j in index_2d.query(*seg1.reprojected_bbox(self.last_pose)) 
+                             if j > i)
+            for j in sorted(pairs):
+                if not i_edited and id(all_segments[j]) not in edited:
+                    continue
+                candidates.append((i, j))
+        return candidates
             
     def make_pickle_compatible(self):
         """
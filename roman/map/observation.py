@@ -1,11 +1,11 @@
 from dataclasses import dataclass, field
 import numpy as np
 import cv2 as cv
-from typing import List, Dict
+from typing import List, Dict, Tuple
 
 from robotdatapy.transform import transform
 
-from roman.map.voxel_grid import VoxelGrid
+from roman.map.voxel_grid import VoxelGrid, SparseVoxelGrid
 
 
 @dataclass
@@ -20,7 +20,7 @@ class Observation():
     mask_downsampled: np.ndarray = None
     point_cloud: np.ndarray = None  # n-by-3 matrix. Each row is a 3D point.
     clip_embedding: np.ndarray = None
-    voxel_grid: Dict[float, VoxelGrid] = field(default_factory=dict)
+    voxel_grid: Dict[Tuple[float, bool], VoxelGrid] = field(default_factory=dict)
 
     def copy(self, include_mask: bool = True, include_ptcld = False):
         ptcld_copy = None
@@ -32,11 +32,12 @@ class Observation():
         else:
             return Observation(self.time, self.pose.copy(), None, None, ptcld_copy)
         
-    def get_voxel_grid(self, voxel_size: float):
+    def get_voxel_grid(self, voxel_size: float, sparse: bool = False):
         """
         Get the voxel bounding box for the point cloud
         """
-        if voxel_size not in self.voxel_grid:
+        if (voxel_size, sparse) not in self.voxel_grid:
             transformed_points = transform(self.pose, self.point_cloud, axis=0)
-            self.voxel_grid[voxel_size] = VoxelGrid.from_points(transformed_points, voxel_size)
-        return self.voxel_grid[voxel_size]
\ No newline at end of file
+            grid_type = SparseVoxelGrid if sparse else VoxelGrid
+            self.voxel_grid[(voxel_size, sparse)] = grid_type.from_points(transformed_points, voxel_size)
+        return self.voxel_grid[(voxel_size, sparse)]
\ No newline at end of file
@@ -0,0 +1,154 @@
+###########################################################
+#
+# prefetch_img_data.py
+#
+# Read-ahead cache of decoded images for ImgData
+#
+###########################################################
+
+import numpy as np
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from robotdatapy.data.img_data import ImgData
+from robotdatapy.data.robot_data import NoDataNearTimeException
+
+class PrefetchImgData():
+
+    def __init__(self, img_data: ImgData, query_times: np.ndarray = None, read_ahead: int = 8,
+                 max_size: int = 32, num_workers: int = 2):
+        """
+        Wraps an ImgData object so that upcoming images are decoded in background threads and
+        kept in a bounded least-recently-used cache keyed by image timestamp. Exposes the same
+        img(t) interface as ImgData, all other attributes are forwarded to the wrapped ImgData.
+
+        Args:
+            img_data (ImgData): Image data to read from
+            query_times (np.ndarray, optional): Times that img will be called with, in order. Used
+                to decide which images to decode ahead of time. If None, the next images in the
+                data are decoded. Defaults to None.
+            read_ahead (int, optional): Number of upcoming images to decode ahead of time.
+                Defaults to 8.
+            max_size (int, optional): Max number of decoded images kept in the cache.
+                Defaults to 32.
+            num_workers (int, optional): Number of decoding threads. Defaults to 2.
+        """
+        assert max_size > read_ahead, "max_size must be larger than read_ahead"
+        self.img_data = img_data
+        self.query_times = None if query_times is None else np.sort(np.asarray(query_times))
+        self.read_ahead = read_ahead
+        self.max_size = max_size
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_decoded = 0
+        self.decode_time = 0.0
+
+        self._cache = OrderedDict() # image index -> decoded image
+        self._pending = dict() # image index -> future of decoded image
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    def __getattr__(self, name):
+        # only called for attributes not found on this object
+        if name == 'img_data':
+            raise AttributeError(name)
+        return getattr(self.img_data, name)
+
+    def img(self, t: float):
+        """
+        Image at time t.
+
+        Args:
+            t (float): time
+
+        Returns:
+            cv image
+        """
+        idx = self.img_data.idx(t)
+        self._prefetch(t, idx)
+        with self._lock:
+            if idx in self._cache:
+                self._cache.move_to_end(idx)
+                self.num_hits += 1
+                return self._cache[idx]
+            future = self._pending.get(idx, None)
+            # counters are only changed under the lock, decode threads also update statistics
+            if future is not None:
+                self.num_hits += 1
+            else:
+                self.num_misses += 1
+
+        if future is not None:
+            return future.result()
+
+        img = self._decode(idx)
+        with self._lock:
+            self._insert(idx, img)
+        return img
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: cache hits and misses, hit rate, number of decoded images, and total and mean
+                decode time in seconds
+        """
+        with self._lock:
+            num_hits, num_misses = self.num_hits, self.num_misses
+            num_decoded, decode_time = self.num_decoded, self.decode_time
+        num_requests = num_hits + num_misses
+        return {
+            'hits': num_hits,
+            'misses': num_misses,
+            'hit_rate': num_hits / num_requests if num_requests > 0 else 0.0,
+            'decoded': num_decoded,
+            'decode_time': decode_time,
+            'mean_decode_time': decode_time / num_decoded if num_decoded > 0 else 0.0
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _prefetch(self, t: float, idx: int):
+        """
+        Schedules decoding of the images that will be requested after time t.
+        """
+        if self.query_times is None:
+            upcoming = range(idx + 1, min(idx + 1 + self.read_ahead, len(self.img_data.times)))
+        else:
+            start = np.searchsorted(self.query_times, t, side='right')
+            upcoming = []
+            for t_next in self.query_times[start:start + self.read_ahead]:
+                try:
+                    upcoming.append(self.img_data.idx(t_next))
+                except NoDataNearTimeException:
+                    continue
+
+        with self._lock:
+            for idx_next in upcoming:
+                if idx_next in self._cache or idx_next in self._pending:
+                    continue
+                self._pending[idx_next] = self._executor.submit(self._decode_and_insert, idx_next)
+
+    def _decode_and_insert(self, idx: int):
+        img = self._decode(idx)
+        with self._lock:
+            self._insert(idx, img)
+            del self._pending[idx]
+        return img
+
+    def _decode(self, idx: int):
+        t0 = time.time()
+        img = self.img_data.img(self.img_data.times[idx])
+        with self._lock:
+            self.decode_time += time.time() - t0
+            self.num_decoded += 1
+        return img
+
+    def _insert(self, idx: int, img):
+        self._cache[idx] = img
+        self._cache.move_to_end(idx)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
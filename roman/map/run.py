@@ -18,6 +18,8 @@ from typing import Tuple
 from dataclasses import dataclass
 import time
 from copy import deepcopy
+from queue import Queue, Empty, Full
+from threading import Thread, Event
 
 from robotdatapy.data.img_data import ImgData
 from robotdatapy.data.pose_data import PoseData
@@ -29,6 +31,7 @@ from roman.object.segment import Segment
 from roman.viz import visualize_map_on_img, visualize_observations_on_img, visualize_3d_on_img
 from roman.map.mapper import Mapper
 from roman.map.fastsam_wrapper import FastSAMWrapper
+from roman.map.prefetch_img_data import PrefetchImgData
 from roman.map.map import ROMANMap
 from roman.params.data_params import DataParams
 from roman.params.mapper_params import MapperParams
@@ -62,6 +65,22 @@ class ROMANMapRunner:
         if verbose: print("Loading depth data for time range {}...".format(self.time_range))
         self.depth_data = self.data_params.load_depth_data()
 
+        if self.data_params.prefetch_frames > 0:
+            if verbose: print("Setting up image prefetching...")
+            query_times = np.arange(self.img_data.t0, self.img_data.tf, self.data_params.dt)
+            img_times = []
+            for t in query_times:
+                try:
+                    img_times.append(self.img_data.nearest_time(t))
+                except NoDataNearTimeException:
+                    continue
+            self.img_data = PrefetchImgData(self.img_data, query_times, 
+                read_ahead=self.data_params.prefetch_frames, 
+                max_size=4*self.data_params.prefetch_frames)
+            self.depth_data = PrefetchImgData(self.depth_data, img_times, 
+                read_ahead=self.data_params.prefetch_frames, 
+                max_size=4*self.data_params.prefetch_frames)
+
         if verbose: print("Loading pose data...")
         self.camera_pose_data = self.data_params.load_pose_data()
         
@@ -105,15 +124,128 @@ class ROMANMapRunner:
 
         return img_output
 
-    def update_fastsam(self, t):
+    def run_pipelined(self, times=None, queue_size: int = 4):
+        """
+        Runs mapping over a sequence of times as a pipeline. Frame lookup runs in a prefetch 
+        thread, FastSAM runs in a worker thread, and the mapper is updated on the calling thread 
+        in time order. Stages are connected by bounded queues, so at most queue_size frames 
+        are buffered between stages.
+
+        Args:
+            times (iterable, optional): Times to process. Defaults to self.times().
+            queue_size (int, optional): Max number of frames buffered between stages. 
+                Defaults to 4.
+
+        Yields:
+            np.array: Visualization image for each time (None if no visualization), as returned 
+                by update
+        """
+        if times is None:
+            times = self.times()
+        done = object() # marks the end of a stage's output
+        stop = Event()
+        frame_queue = Queue(maxsize=queue_size)
+        fastsam_queue = Queue(maxsize=queue_size)
 
+        def put(queue, item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Full:
+                    continue
+
+        def prefetch():
+            try:
+                for t in times:
+                    if stop.is_set():
+                        return
+                    t0 = time.time()
+                    frame = self.load_frame(t)
+                    put(frame_queue, (t, frame, time.time() - t0))
+                put(frame_queue, done)
+            except Exception as e:
+                put(frame_queue, e)
+
+        def segment():
+            try:
+                while not stop.is_set():
+                    item = frame_queue.get()
+                    if item is done or isinstance(item, Exception):
+                        put(fastsam_queue, item)
+                        return
+                    t, frame, load_time = item
+                    t0 = time.time()
+                    observations = None
+                    if frame is not None:
+                        img_t, img, img_depth, pose_odom_camera = frame
+                        observations = self.fastsam.run(img_t, pose_odom_camera, img, img_depth=img_depth)
+                    put(fastsam_queue, (t, frame, observations, load_time + time.time() - t0))
+            except Exception as e:
+                put(fastsam_queue, e)
+
+        threads = [Thread(target=prefetch, daemon=True), Thread(target=segment, daemon=True)]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = fastsam_queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                t, frame, observations, fastsam_time = item
+
+                if self.verbose: print(f"t: {t - self.img_data.t0:.2f} = {t}")
+                img_output = None
+                update_t1 = time.time()
+                if frame is not None:
+                    img_t, img, _, pose_odom_camera = frame
+                    img_output = self.update_segment_track(img_t, observations, pose_odom_camera, img)
+                update_t2 = time.time()
+                self.processing_times.map_times.append(update_t2 - update_t1)
+                self.processing_times.fastsam_times.append(fastsam_time)
+                self.processing_times.total_times.append(fastsam_time + update_t2 - update_t1)
+
+                yield img_output
+        finally:
+            stop.set()
+            # unblock stages waiting on a full queue or an empty input queue
+            for queue in [frame_queue, fastsam_queue]:
+                try:
+                    while True:
+                        queue.get_nowait()
+                except Empty:
+                    pass
+            try:
+                frame_queue.put_nowait(done)
+            except Full: # segmentation stage is not waiting for input and will see stop
+                pass
+            for thread in threads:
+                thread.join()
+
+    def load_frame(self, t):
+        """
+        Looks up the image, depth image, and camera pose nearest to a time.
+
+        Returns:
+            Tuple: (img_t, img, img_depth, pose_odom_camera), or None if there is no data near t
+        """
         try:
             img_t = self.img_data.nearest_time(t)
             img = self.img_data.img(img_t)
             img_depth = self.depth_data.img(img_t)
             pose_odom_camera = self.camera_pose_data.T_WB(img_t)
         except NoDataNearTimeException:
+            return None
+        return img_t, img, img_depth, pose_odom_camera
+
+    def update_fastsam(self, t):
+
+        frame = self.load_frame(t)
+        if frame is None:
             return None, None, None, None
+        img_t, img, img_depth, pose_odom_camera = frame
         
         observations = self.fastsam.run(img_t, pose_odom_camera, img, img_depth=img_depth)
         return img_t, observations, pose_odom_camera, img
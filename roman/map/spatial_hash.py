@@ -0,0 +1,106 @@
+import numpy as np
+from itertools import product
+from typing import Hashable, Set
+
+class SpatialHashGrid():
+
+    def __init__(self, cell_size: float = 1.0):
+        """
+        Hash grid that stores items by the axis-aligned bounding boxes (AABBs) they cover.
+        Items can be inserted, moved, and removed incrementally so that the grid does not need
+        to be rebuilt when only a few items change.
+
+        Args:
+            cell_size (float, optional): Side length of the hash grid cells. Defaults to 1.0.
+        """
+        assert cell_size > 0, "cell_size must be positive"
+        self.cell_size = cell_size
+        self._cells = dict() # cell -> set of keys
+        self._items = dict() # key -> (min_corner, max_corner, cells)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key: Hashable):
+        return key in self._items
+
+    def keys(self):
+        return self._items.keys()
+
+    def insert(self, key: Hashable, min_corner: np.ndarray, max_corner: np.ndarray):
+        """
+        Insert an item into the grid. If the item is already in the grid, its bounding box is
+        updated.
+
+        Args:
+            key (Hashable): Item key
+            min_corner (np.ndarray, shape=(3,)): AABB minimum corner
+            max_corner (np.ndarray, shape=(3,)): AABB maximum corner
+        """
+        min_corner = np.asarray(min_corner, dtype=np.float64).reshape(-1)
+        max_corner = np.asarray(max_corner, dtype=np.float64).reshape(-1)
+        cells = self._cells_covered(min_corner, max_corner)
+        if key in self._items:
+            old_cells = self._items[key][2]
+            if old_cells != cells:
+                self._remove_from_cells(key, old_cells - cells)
+                self._add_to_cells(key, cells - old_cells)
+        else:
+            self._add_to_cells(key, cells)
+        self._items[key] = (min_corner, max_corner, cells)
+
+    def update(self, key: Hashable, min_corner: np.ndarray, max_corner: np.ndarray):
+        """
+        Move an item to a new bounding box. Does nothing if the bounding box is unchanged.
+        """
+        if key in self._items and np.array_equal(self._items[key][0], min_corner) \
+                and np.array_equal(self._items[key][1], max_corner):
+            return
+        self.insert(key, min_corner, max_corner)
+
+    def remove(self, key: Hashable):
+        if key not in self._items:
+            return
+        self._remove_from_cells(key, self._items[key][2])
+        del self._items[key]
+
+    def query(self, min_corner: np.ndarray, max_corner: np.ndarray, margin: float = 0.0) -> Set:
+        """
+        Find all items whose bounding boxes overlap the query bounding box.
+
+        Args:
+            min_corner (np.ndarray, shape=(3,)): Query AABB minimum corner
+            max_corner (np.ndarray, shape=(3,)): Query AABB maximum corner
+            margin (float, optional): Amount to inflate the query box by on each side.
+                Defaults to 0.0.
+
+        Returns:
+            Set: keys of items overlapping the query box
+        """
+        min_corner = np.asarray(min_corner, dtype=np.float64).reshape(-1) - margin
+        max_corner = np.asarray(max_corner, dtype=np.float64).reshape(-1) + margin
+        candidates = set()
+        for cell in self._cells_covered(min_corner, max_corner):
+            candidates.update(self._cells.get(cell, ()))
+        overlapping = set()
+        for key in candidates:
+            item_min, item_max, _ = self._items[key]
+            if np.all(item_min <= max_corner) and np.all(min_corner <= item_max):
+                overlapping.add(key)
+        return overlapping
+
+    def _cells_covered(self, min_corner: np.ndarray, max_corner: np.ndarray) -> frozenset:
+        lower = np.floor(min_corner / self.cell_size).astype(np.int64)
+        upper = np.floor(max_corner / self.cell_size).astype(np.int64)
+        return frozenset(product(*[range(lo, up + 1) for lo, up in zip(lower, upper)]))
+
+    def _add_to_cells(self, key: Hashable, cells):
+        for cell in cells:
+            self._cells.setdefault(cell, set()).add(key)
+
+    def _remove_from_cells(self, key: Hashable, cells):
+        for cell in cells:
+            cell_keys = self._cells[cell]
+            cell_keys.discard(key)
+            if len(cell_keys) == 0:
+                del self._cells[cell]
@@ -1,7 +1,27 @@
 import numpy as np
 from dataclasses import dataclass
-import open3d as o3d
 import functools
+from scipy.sparse import csr_matrix
+from typing import List
+
+# voxel indices are packed into a single int64 key using 21 bits per axis
+KEY_BITS = 21
+KEY_OFFSET = 1 << (KEY_BITS - 1)
+
+def pack_voxel_keys(indices: np.ndarray) -> np.ndarray:
+    """
+    Packs integer voxel indices into int64 keys.
+
+    Args:
+        indices (np.ndarray, shape=(n,3)): Integer voxel indices
+
+    Returns:
+        np.ndarray, shape=(n,): Packed voxel keys
+    """
+    shifted = indices.astype(np.int64) + KEY_OFFSET
+    assert np.all(shifted >= 0) and np.all(shifted < 1 << KEY_BITS), \
+        "Voxel indices out of range for packed keys"
+    return (shifted[:,0] << 2*KEY_BITS) | (shifted[:,1] << KEY_BITS) | shifted[:,2]
 
 @dataclass(frozen=True)
 class VoxelGrid():
@@ -29,6 +49,17 @@ class VoxelGrid():
     def max_corner_int(self):
         return (self.max_corner / self.voxel_size).astype(np.int64)
     
+    @functools.cached_property
+    def occupied_keys(self):
+        """
+        Sorted packed keys (global voxel indices) of the occupied voxels inside 
+        [min_corner_int, max_corner_int), the region used when intersecting grids.
+        """
+        local_indices = np.argwhere(self.voxels)
+        shape_int = (self.max_corner_int - self.min_corner_int).reshape(-1)
+        local_indices = local_indices[np.all(local_indices < shape_int, axis=1)]
+        return np.sort(pack_voxel_keys(local_indices + self.min_corner_int.reshape(-1)))
+
     def intersection(self, other):
         assert type(other) == VoxelGrid, "Can only intersect with another VoxelGrid"
         assert self.voxel_size == other.voxel_size, "Voxel sizes must be the same"
@@ -82,17 +113,163 @@ class VoxelGrid():
         """
         Create a voxel grid from a point cloud
         """
-        min_corner = np.array([np.floor(np.min(points, axis=0) / voxel_size) * voxel_size])
-        max_corner = np.array([np.ceil(np.max(points, axis=0) / voxel_size) * voxel_size])
-        pcd_o3d = o3d.geometry.PointCloud()
-        pcd_o3d.points = o3d.utility.Vector3dVector(points)
-        voxels_o3d = o3d.geometry.VoxelGrid.create_from_point_cloud(pcd_o3d, voxel_size=voxel_size)
-        voxel_o3d_list = voxels_o3d.get_voxels()  # returns list of voxels
-        indices = np.stack(list(vx.grid_index for vx in voxel_o3d_list))
+        min_corner, max_corner, indices = _voxelize(points, voxel_size)
         voxels = np.zeros(((max_corner - min_corner) / voxel_size + 2).astype(np.uint32).reshape(-1), dtype=np.uint8)
-        # print(((max_corner - min_corner) / voxel_size).astype(np.uint32))
-        # print(((max_corner - min_corner) / voxel_size).astype(np.uint32).reshape(-1))
-        # print(voxels.shape)
-        # print(indices)
         voxels[indices[:,0], indices[:,1], indices[:,2]] = 1
-        return cls(min_corner, max_corner, voxel_size, voxels)
\ No newline at end of file
+        return cls(min_corner, max_corner, voxel_size, voxels)
+    
+    @staticmethod
+    def iou_matrix(grids1: List['VoxelGrid'], grids2: List['VoxelGrid']) -> np.ndarray:
+        """
+        Computes the IOU between every pair of voxel grids from two lists at once. Occupied voxel 
+        keys are mapped onto a shared index and intersections are counted with a sparse matrix 
+        product. Gives the same values as calling iou on each pair. Works with both VoxelGrid 
+        and SparseVoxelGrid.
+
+        Args:
+            grids1 (List[VoxelGrid]): First list of voxel grids
+            grids2 (List[VoxelGrid]): Second list of voxel grids
+
+        Returns:
+            np.ndarray, shape=(len(grids1), len(grids2)): IOU matrix
+        """
+        if len(grids1) == 0 or len(grids2) == 0:
+            return np.zeros((len(grids1), len(grids2)))
+        voxel_size = grids1[0].voxel_size
+        assert all(grid.voxel_size == voxel_size for grid in grids1 + grids2), \
+            "Voxel sizes must be the same"
+        
+        keys = [grid.occupied_keys for grid in grids1 + grids2]
+        grid_idx = np.repeat(np.arange(len(keys)), [len(k) for k in keys])
+        _, key_idx = np.unique(np.concatenate(keys), return_inverse=True)
+        key_idx = key_idx.reshape(-1)
+        occupancy = csr_matrix((np.ones(len(key_idx), dtype=np.int64), (grid_idx, key_idx)),
+                               shape=(len(keys), np.max(key_idx, initial=-1) + 1))
+        num_intersecting = (occupancy[:len(grids1)] @ occupancy[len(grids1):].T).toarray()
+
+        # grids whose corners do not overlap have no intersection
+        min_corners1 = np.stack([grid.min_corner.reshape(-1) for grid in grids1])[:,None,:]
+        max_corners1 = np.stack([grid.max_corner.reshape(-1) for grid in grids1])[:,None,:]
+        min_corners2 = np.stack([grid.min_corner.reshape(-1) for grid in grids2])[None,:,:]
+        max_corners2 = np.stack([grid.max_corner.reshape(-1) for grid in grids2])[None,:,:]
+        overlapping = np.all(np.maximum(min_corners1, min_corners2) < 
+                             np.minimum(max_corners1, max_corners2), axis=2)
+
+        intersection = np.where(overlapping, num_intersecting * voxel_size**3, 0.0)
+        volumes1 = np.array([grid.volume for grid in grids1])[:,None]
+        volumes2 = np.array([grid.volume for grid in grids2])[None,:]
+        return intersection / (volumes1 + volumes2 - intersection)
+
+@dataclass(frozen=True)
+class SparseVoxelGrid():
+    """
+    Voxel bounding box data class storing only the occupied voxels as sorted packed keys. 
+    Memory and intersection cost scale with the number of occupied voxels rather than the 
+    bounding box volume. Gives the same volumes and IOUs as VoxelGrid.
+    """
+    min_corner: np.ndarray
+    max_corner: np.ndarray
+    voxel_size: float
+    keys: np.ndarray
+    min_point: np.ndarray = None
+
+    @functools.cached_property
+    def num_occupied(self):
+        return len(self.keys)
+    
+    @functools.cached_property
+    def volume(self):
+        return self.num_occupied * self.voxel_size**3
+
+    @property
+    def min_corner_int(self):
+        return (self.min_corner / self.voxel_size).astype(np.int64)
+    
+    @property
+    def max_corner_int(self):
+        return (self.max_corner / self.voxel_size).astype(np.int64)
+    
+    @functools.cached_property
+    def occupied_keys(self):
+        """
+        Sorted packed keys of the occupied voxels inside [min_corner_int, max_corner_int), the 
+        region used when intersecting grids.
+        """
+        shifted_max = self.max_corner_int.reshape(-1) + KEY_OFFSET
+        mask = (1 << KEY_BITS) - 1
+        inside = ((self.keys >> 2*KEY_BITS) < shifted_max[0]) \
+            & (((self.keys >> KEY_BITS) & mask) < shifted_max[1]) \
+            & ((self.keys & mask) < shifted_max[2])
+        return self.keys[inside]
+    
+    def intersection(self, other):
+        assert isinstance(other, (VoxelGrid, SparseVoxelGrid)), \
+            "Can only intersect with another VoxelGrid or SparseVoxelGrid"
+        assert self.voxel_size == other.voxel_size, "Voxel sizes must be the same"
+        min_corner = np.maximum(self.min_corner, other.min_corner)
+        max_corner = np.minimum(self.max_corner, other.max_corner)
+
+        # voxel grids do not overlap
+        if np.any(min_corner >= max_corner):
+            return 0.0
+        
+        num_occupied = len(np.intersect1d(self.occupied_keys, other.occupied_keys, assume_unique=True))
+        return num_occupied * self.voxel_size**3
+    
+    def union(self, other):
+        return self.volume + other.volume - self.intersection(other)
+    
+    def iou(self, other):
+        intersection = self.intersection(other)
+        return intersection / (self.volume + other.volume - intersection)
+    
+    @classmethod
+    def from_points(cls, points: np.ndarray, voxel_size: float):
+        """
+        Create a sparse voxel grid from a point cloud
+        """
+        min_corner, max_corner, indices = _voxelize(points, voxel_size)
+        keys = np.unique(pack_voxel_keys(indices + (min_corner / voxel_size).astype(np.int64)))
+        return cls(min_corner, max_corner, voxel_size, keys, np.min(points, axis=0))
+    
+    def add_points(self, points: np.ndarray):
+        """
+        Create a voxel grid that also contains the given points. Only the new points are 
+        voxelized and the result is the same as from_points on all of the points.
+
+        Args:
+            points (np.ndarray, shape=(n,3)): New points
+
+        Returns:
+            SparseVoxelGrid: Voxel grid with the new points added. None if the new points lie 
+                below the grid's minimum point, which shifts the voxel origin, so the grid needs 
+                to be rebuilt from all points.
+        """
+        if len(points) == 0:
+            return self
+        if self.min_point is None or np.any(np.min(points, axis=0) < self.min_point):
+            return None
+        _, max_corner, indices = _voxelize(points, self.voxel_size, self.min_point)
+        keys = np.union1d(self.keys, pack_voxel_keys(indices + self.min_corner_int.reshape(-1)))
+        return SparseVoxelGrid(self.min_corner, np.maximum(self.max_corner, max_corner), 
+                               self.voxel_size, keys, self.min_point)
+
+def _voxelize(points: np.ndarray, voxel_size: float, min_point: np.ndarray = None):
+    """
+    Computes the voxel grid corners of a point cloud and the occupied voxel indices relative 
+    to the minimum corner. If min_point is given, it is used in place of the minimum of the 
+    points to place the voxel origin.
+    """
+    min_corner = np.array([np.floor(np.min(points, axis=0) / voxel_size) * voxel_size])
+    max_corner = np.array([np.ceil(np.max(points, axis=0) / voxel_size) * voxel_size])
+    # same indexing as o3d.geometry.VoxelGrid.create_from_point_cloud, which places the 
+    # voxel origin half a voxel below the minimum point
+    if min_point is None:
+        min_point = np.min(points, axis=0)
+    voxel_origin = min_point - voxel_size * 0.5
+    indices = np.floor((points - voxel_origin) / voxel_size).astype(np.int64)
+    # unique over flattened indices is much faster than np.unique(..., axis=0)
+    shape = np.max(indices, axis=0) + 1
+    indices = np.stack(np.unravel_index(
+        np.unique(np.ravel_multi_index(indices.T, shape)), shape), axis=1)
+    return min_corner, max_corner, indices
@@ -11,16 +11,11 @@ from robotdatapy.camera import xyz_2_pixel, pixel_depth_2_xyz
 
 import open3d as o3d
 from roman.map.observation import Observation
-from roman.map.voxel_grid import VoxelGrid
+from roman.map.voxel_grid import VoxelGrid, SparseVoxelGrid, pack_voxel_keys
 from roman.object.object import Object
 
-# TODO: use edited to help save computation in computing things 
-# like volume, extent, and pca shape attributes
-
 class SegmentMinimalData(Object):
     
-    # TODO: Handle center ref for segment minimal data
-    
     def __init__(
         self,
         id: int,
@@ -32,7 +27,9 @@ class SegmentMinimalData(Object):
         extent: np.array,
         semantic_descriptor: np.array,
         first_seen: float,
-        last_seen: float
+        last_seen: float,
+        center_ref: str = "mean",
+        mean: np.array = None
     ):
         super().__init__(center, 3, id, volume=volume)
         self._linearity = linearity
@@ -42,6 +39,23 @@ class SegmentMinimalData(Object):
         self.semantic_descriptor = semantic_descriptor
         self.first_seen = first_seen
         self.last_seen = last_seen
+        self._center_ref = center_ref # reference point used for center
+        # mean of the segment points, only stored separately if it is not the center
+        self._mean = None if mean is None else np.asarray(mean, dtype=np.float64).reshape(-1)
+        
+    @property
+    def mean(self):
+        """Mean of the segment points, None if it is not known"""
+        if self._mean is not None:
+            return self._mean.copy()
+        elif self._center_ref == 'mean':
+            return self.centroid.reshape(-1).copy()
+        return None
+    
+    def transform(self, T):
+        super().transform(T)
+        if self._mean is not None:
+            self._mean = transform(T, self._mean)
         
     def normalized_eigenvalues(self):
         return None
@@ -54,9 +68,115 @@ class SegmentMinimalData(Object):
 
     def scattering(self, e=None):
         return self._scattering
+    
+    def set_center_ref(self, new_center_ref):
+        # the center is fixed when the minimal data is created
+        assert new_center_ref == self._center_ref, \
+            f"Minimal data center reference point is {self._center_ref}, cannot change it"
+        
+    def minimal_data(self):
+        return self
+
+class SegmentView(SegmentMinimalData):
+    """
+    Minimal segment data with lazy access to the segment's points. Points are sliced from an 
+    array shared by all segments of a map (which may be memory-mapped) only when accessed. 
+    Transforms are accumulated and applied to the points when they are accessed.
+    """
+    
+    def __init__(
+        self,
+        id: int,
+        center: np.array,
+        volume: float,
+        linearity: float,
+        planarity: float,
+        scattering: float,
+        extent: np.array,
+        semantic_descriptor: np.array,
+        first_seen: float,
+        last_seen: float,
+        bottom_middle_center: np.array,
+        all_points: np.array,
+        point_start: int,
+        point_end: int
+    ):
+        super().__init__(id, center, volume, linearity, planarity, scattering, extent, 
+                         semantic_descriptor, first_seen, last_seen)
+        self._bottom_middle_center = bottom_middle_center
+        self._all_points = all_points
+        self._point_start = point_start
+        self._point_end = point_end
+        self._T = None # transform applied to the stored points
+        
+    @property
+    def points(self):
+        points = self._all_points[self._point_start:self._point_end]
+        if self._T is not None:
+            points = transform(self._T, points, axis=0)
+        return points
+    
+    @property
+    def num_points(self):
+        return self._point_end - self._point_start
+    
+    @property
+    def center(self):
+        if self._center_ref == 'bottom_middle':
+            return self._bottom_middle_center.copy()
+        return self.centroid
+    
+    @property
+    def mean(self):
+        """Mean of the segment points"""
+        return self.centroid.reshape(-1).copy()
+    
+    def set_center_ref(self, new_center_ref):
+        assert new_center_ref in ['bottom_middle', 'mean']
+        self._center_ref = new_center_ref
+        
+    def transform(self, T):
+        super().transform(T)
+        self._bottom_middle_center = transform(T, np.asarray(self._bottom_middle_center))
+        self._T = T if self._T is None else T @ self._T
+        
+    def __copy__(self):
+        # shallow copies keep sharing the map's points array
+        view = self.__class__.__new__(self.__class__)
+        view.__dict__.update(self.__dict__)
+        return view
+        
+    def __getstate__(self):
+        # deep copies and pickles only hold this segment's points, not the array shared with the 
+        # rest of the map
+        state = self.__dict__.copy()
+        state['_all_points'] = np.array(self._all_points[self._point_start:self._point_end])
+        state['_point_start'] = 0
+        state['_point_end'] = self._point_end - self._point_start
+        state['_bottom_middle_center'] = np.array(self._bottom_middle_center)
+        return state
+        
+    def minimal_data(self):
+        return SegmentMinimalData(
+            self.id,
+            np.array(self.center, dtype=np.float64),
+            self.volume,
+            self._linearity,
+            self._planarity,
+            self._scattering,
+            self.extent,
+            self.semantic_descriptor,
+            self.first_seen,
+            self.last_seen,
+            self._center_ref,
+            mean=self.mean
+        )
 
 class Segment(Object):
 
+    # statistical outlier removal is rerun once the number of points grows by this factor
+    outlier_removal_growth = 1.5
+
     # TODO: separate from observation and from points class
     def __init__(self, observation: Observation, camera_params: CameraParams, 
                  id: int = 0, voxel_size: float = 0.05):
@@ -69,9 +189,12 @@ class Segment(Object):
         self.num_sightings = 1
         self.edited = True
         self.last_observation = observation
+        self._points_version = 0 # incremented whenever the points change
+        self._geometry = dict() # geometric summaries of the points, see _cached_geometry
+        self._geometry_version = 0
         self.points = None
+        self._num_points_at_outlier_removal = 0
         self.voxel_size = voxel_size  # voxel size used for maintaining point clouds
-        self._obb = None
         self.voxel_grid = dict()
         self.last_propagated_mask = None
         self.last_propagated_time = None
@@ -96,7 +219,6 @@ class Segment(Object):
         #         self.reconstruction_from_observations(self.observations + [observation], width_height=False)
         #     except:
         #         return
-        self.reset_obb()
             
         # Integrate point measurements
         if integrate_points:
@@ -129,7 +251,6 @@ class Segment(Object):
         Args:
             observation (Observation): input observation object
         """
-        self.reset_obb() # reset bbox
 
         if observation.point_cloud is None:
             return
@@ -149,32 +270,107 @@ class Segment(Object):
         Args:
             segment (Segment): _description_
         """
-        self.reset_obb() # reset bbox
         if segment.num_points > 0:
             self._add_points(segment.points)
         else: # TODO: not sure how this is reached?
             self.points = segment.points
+            self.voxel_grid = dict()
 
     def _add_points(self, points):
         assert points.shape[1] == 3
         if points.shape[0] == 0:
             return
+        new_points = self._downsample_new_points(points)
+        self._append_points(new_points)
+        points_removed = False
+        if self.num_points >= self.outlier_removal_growth * self._num_points_at_outlier_removal:
+            points_removed = self._remove_outliers()
+        self._update_voxel_grids(new_points, rebuild=points_removed)
+
+    def _append_points(self, points):
+        """
+        Appends points to the point buffer, growing the buffer geometrically when it is full
+        """
+        if points.shape[0] == 0:
+            return
+        if self._point_sums is not None:
+            reference, point_sum, outer_sum = self._point_sums
+            offsets = points - reference
+            self._point_sums = (reference, point_sum + offsets.sum(axis=0), outer_sum + offsets.T @ offsets)
+        num_points = self.num_points + points.shape[0]
+        if self._point_buffer is None or num_points > self._point_buffer.shape[0]:
+            buffer = np.empty((max(num_points, 2*self.num_points), 3))
+            if self.num_points > 0:
+                buffer[:self.num_points] = self.points
+            self._point_buffer = buffer
+        self._point_buffer[self.num_points:num_points] = points
+        self._num_points = num_points
+        self._points_version += 1
+
+    def _downsample_new_points(self, points):
+        """
+        Voxel downsamples points before they are added to the segment. Only voxels that are not 
+        already occupied by the segment's points are kept, each represented by the mean of the 
+        new points falling inside of it.
+
+        Args:
+            points (np.ndarray, shape=(n,3)): New points
+
+        Returns:
+            np.ndarray, shape=(m,3): Downsampled new points
+        """
+        if self._point_cells is None:
+            self._point_cells = set() if self.points is None else \
+                set(pack_voxel_keys(np.floor(self.points / self.voxel_size)).tolist())
+        cells, inverse = np.unique(pack_voxel_keys(np.floor(points / self.voxel_size)), 
+                                   return_inverse=True)
+        inverse = inverse.reshape(-1)
+        is_new = np.fromiter((cell not in self._point_cells for cell in cells.tolist()), 
+                             dtype=bool, count=len(cells))
+        self._point_cells.update(cells[is_new].tolist())
+        counts = np.bincount(inverse, minlength=len(cells))[is_new]
+        sums = np.stack([np.bincount(inverse, weights=points[:,i], minlength=len(cells))[is_new] 
+                         for i in range(3)], axis=1)
+        return sums / counts[:,None]
+    
+    def _remove_outliers(self) -> bool:
+        """
+        Runs statistical outlier removal over all of the segment's points
+
+        Returns:
+            bool: True if any points were removed
+        """
         if self.points is None:
-            self.points = points
-        else:
-            self.points = np.concatenate((self.points, points), axis=0)
-        self._cleanup_points()
+            return False
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(self.points)
+        _, inliers = pcd.remove_statistical_outlier(10, 1.0)
+        points_removed = len(inliers) < self.num_points
+        if points_removed:
+            self.points = self.points[np.asarray(inliers, dtype=np.int64)]
+        self._num_points_at_outlier_removal = self.num_points
+        return points_removed
     
-    def _cleanup_points(self):
-        if self.points is not None:
-            pcd = o3d.geometry.PointCloud()
-            pcd.points.extend(self.points)
-            pcd_sampled = pcd.voxel_down_sample(voxel_size=self.voxel_size)
-            pcd_pruned, _ = pcd_sampled.remove_statistical_outlier(10, 1.0)
-            if pcd_pruned.is_empty():
-                self.points = None
+    def _update_voxel_grids(self, new_points: np.ndarray, rebuild: bool = False):
+        """
+        Keeps the cached voxel grids up to date after points are added. Sparse grids have the 
+        voxels of the new points added, all other grids are dropped and rebuilt when next 
+        requested.
+
+        Args:
+            new_points (np.ndarray, shape=(n,3)): Newly integrated points
+            rebuild (bool, optional): If true, all grids are dropped (e.g., because points were 
+                removed). Defaults to False.
+        """
+        if rebuild or self.points is None:
+            self.voxel_grid = dict()
+            return
+        for (voxel_size, sparse), grid in list(self.voxel_grid.items()):
+            grid = grid.add_points(new_points) if sparse else None
+            if grid is None:
+                del self.voxel_grid[(voxel_size, sparse)]
             else:
-                self.points = np.asarray(pcd_pruned.points) 
+                self.voxel_grid[(voxel_size, sparse)] = grid
                 
     def final_cleanup(self, epsilon=0.25, min_points=10):
         """
@@ -184,6 +380,8 @@ class Segment(Object):
             epsilon (float, optional): Max distance between two samples to be eligible to be in same cluster. Defaults to 0.25.
             min_points (int, optional): Number of points needed to form a cluster. Defaults to 10.
         """
+        if self.num_points != self._num_points_at_outlier_removal:
+            self._remove_outliers()
         if self.points is not None:
             pcd = o3d.geometry.PointCloud()
             pcd.points = o3d.utility.Vector3dVector(self.points)
@@ -203,69 +401,132 @@ class Segment(Object):
             # Filter out any points not belonging to max cluster
             filtered_indices = np.where(labels == max_cluster)[0]
             self.points = self.points[filtered_indices]
+            self.voxel_grid = dict()
                
 
+    @property
+    def points(self):
+        if self._num_points == 0:
+            return None
+        return self._point_buffer[:self._num_points]
+    
+    @points.setter
+    def points(self, points):
+        self._point_buffer = None if points is None else np.asarray(points, dtype=np.float64)
+        self._num_points = 0 if points is None else self._point_buffer.shape[0]
+        self._point_cells = None # packed keys of the voxels occupied by points, built lazily
+        self._point_sums = None # running point sums, built lazily
+        self.voxel_grid = dict() # incrementally updated grids only hold the old points
+        self._points_version += 1
+        
     @property
     def num_points(self):
-        if self.points is None:
-            return 0
-        else:
-            return self.points.shape[0]
+        return self._num_points
         
     def reset_obb(self):
-        self._obb = None
+        self._geometry = dict()
         self.voxel_grid = dict()
+
+    def _cached_geometry(self, name: str, compute: callable):
+        """
+        Returns a geometric summary of the points (e.g., OBB, mean, eigenvalues), computing it 
+        only if the points have changed since it was last computed.
+        """
+        if self._geometry_version != self._points_version:
+            self._geometry = dict()
+            self._geometry_version = self._points_version
+        if name not in self._geometry:
+            self._geometry[name] = compute()
+        return self._geometry[name]
+    
+    def _point_statistics(self):
+        """
+        Running sum and sum of outer products of the points, taken relative to a reference 
+        point for numerical stability. Updated in O(new points) as points are appended.
+
+        Returns:
+            Tuple[np.ndarray]: reference point, sum of offsets, sum of offset outer products
+        """
+        if self._point_sums is None:
+            reference = self.points[0].copy()
+            offsets = self.points - reference
+            self._point_sums = (reference, offsets.sum(axis=0), offsets.T @ offsets)
+        return self._point_sums
+    
+    @property
+    def mean(self):
+        """Mean of the segment points"""
+        def compute():
+            reference, point_sum, _ = self._point_statistics()
+            return reference + point_sum / self.num_points
+        return self._cached_geometry('mean', compute)
+    
+    @property
+    def covariance(self):
+        """Covariance of the segment points (normalized by the number of points)"""
+        def compute():
+            _, point_sum, outer_sum = self._point_statistics()
+            mean_offset = point_sum / self.num_points
+            return outer_sum / self.num_points - np.outer(mean_offset, mean_offset)
+        return self._cached_geometry('covariance', compute)
+    
+    @property
+    def obb(self):
+        return self._cached_geometry('obb', 
+            lambda: o3d.geometry.OrientedBoundingBox.create_from_points(
+                o3d.utility.Vector3dVector(self.points)))
         
     @property
     def volume(self):
         if self.num_points > 4: # 4 is the minimum number of points needed to define a 3D box
-            if self._obb is None:
-                self._obb = o3d.geometry.OrientedBoundingBox.create_from_points(
-                                o3d.utility.Vector3dVector(self.points))
-            volume = self._obb.volume()
-            return volume
+            return self.obb.volume()
         else:
             return 0.0
         
     @property
     def extent(self):
         if self.num_points > 4:
-            if self._obb is None:
-                self._obb = o3d.geometry.OrientedBoundingBox.create_from_points(
-                                o3d.utility.Vector3dVector(self.points))
-            extent = self._obb.extent
-            return extent
+            return self.obb.extent
         else:
             return np.zeros(3)
         
     @property
     def center(self):
         if self._center_ref == 'bottom_middle':
-            pt = np.median(self.points, axis=0)
-            pt[2] = np.min(self.points[:,2])
-            return pt
+            def compute():
+                pt = np.median(self.points, axis=0)
+                pt[2] = np.min(self.points[:,2])
+                return pt
+            return self._cached_geometry('bottom_middle', compute).copy()
         elif self._center_ref == 'mean':
-            pcd = o3d.geometry.PointCloud()
-            pcd.points = o3d.utility.Vector3dVector(self.points)
-            return pcd.get_center().reshape(self.dim, 1)
+            return self.mean.reshape(self.dim, 1).copy()
         else:
             assert False, "Invalid center reference point type"
         
-    def get_voxel_grid(self, voxel_size: float) -> VoxelGrid:
+    def get_voxel_grid(self, voxel_size: float, sparse: bool = False) -> VoxelGrid:
         if self.num_points > 0:
-            if voxel_size not in self.voxel_grid:
-                self.voxel_grid[voxel_size] = VoxelGrid.from_points(self.points, voxel_size)
-            return self.voxel_grid[voxel_size]
+            if (voxel_size, sparse) not in self.voxel_grid:
+                grid_type = SparseVoxelGrid if sparse else VoxelGrid
+                self.voxel_grid[(voxel_size, sparse)] = grid_type.from_points(self.points, voxel_size)
+            return self.voxel_grid[(voxel_size, sparse)]
         raise ValueError("No points in segment")
         
+    @property
+    def aabb(self):
+        """Axis-aligned bounding box of the segment points as (min_corner, max_corner). None if 
+        the segment has no points.
+        """
+        if self.num_points == 0:
+            return None
+        return self._cached_geometry('aabb', 
+            lambda: (np.min(self.points, axis=0), np.max(self.points, axis=0)))
+
     def aabb_volume(self):
         """Return the volume of the 3D axis-aligned bounding box
         """
         if self.num_points > 0:
-            aabb = o3d.geometry.AxisAlignedBoundingBox.create_from_points(
-                o3d.utility.Vector3dVector(self.points)
-            )
-            return aabb.volume()
+            min_corner, max_corner = self.aabb
+            return np.prod(max_corner - min_corner)
         return 0.0
 
     @property
@@ -309,6 +570,46 @@ class Segment(Object):
         return pixels
     
     def reprojected_bbox(self, pose):
+        """
+        Bounding box of the segment points projected into the image at the given camera pose. 
+        The result for the most recent pose is cached until the points change.
+
+        Returns:
+            Tuple[np.ndarray]: (upper_left, lower_right) pixel corners, or None if the segment 
+                does not project into the image
+        """
+        cached_pose, bbox = self._cached_geometry('reprojected_bbox', lambda: (None, None))
+        if cached_pose is None or not np.array_equal(cached_pose, pose):
+            bbox = self._reprojected_bbox(pose)
+            self._geometry['reprojected_bbox'] = (np.array(pose, copy=True), bbox)
+        return bbox
+    
+    def projected_iou(self, other, pose) -> float:
+        """
+        IOU of the reprojected bounding boxes of two segments, equal to the IOU of their 
+        reconstructed masks but computed from the rectangle corners.
+
+        Args:
+            other (Segment): Other segment
+            pose (np.ndarray, shape=(4,4)): Camera pose
+
+        Returns:
+            float: Projected IOU, 0.0 if neither segment projects into the image
+        """
+        bbox1 = self.reprojected_bbox(pose)
+        bbox2 = other.reprojected_bbox(pose)
+        area1 = 0 if bbox1 is None else np.prod(bbox1[1] - bbox1[0])
+        area2 = 0 if bbox2 is None else np.prod(bbox2[1] - bbox2[0])
+        intersection = 0
+        if bbox1 is not None and bbox2 is not None:
+            overlap = np.minimum(bbox1[1], bbox2[1]) - np.maximum(bbox1[0], bbox2[0])
+            intersection = np.prod(np.maximum(overlap, 0))
+        union = area1 + area2 - intersection
+        if union == 0:
+            return 0.0
+        return float(intersection) / float(union)
+
+    def _reprojected_bbox(self, pose):
         pixels = self._pixels_2d(pose)
         if pixels is None:
             return None
@@ -381,11 +682,10 @@ class Segment(Object):
         as a np array [e1, e2, e3]
         e1 >= e2 >= e3 so that the sum is one
         """
-        pcd = o3d.geometry.PointCloud()
-        pcd.points = o3d.utility.Vector3dVector(self.points)
-        _, C = pcd.compute_mean_and_covariance()
-        _, eigvals, _ = np.linalg.svd(C)  # svd return in descending order
-        return eigvals / eigvals.sum()
+        def compute():
+            _, eigvals, _ = np.linalg.svd(self.covariance)  # svd return in descending order
+            return eigvals / eigvals.sum()
+        return self._cached_geometry('normalized_eigenvalues', compute).copy()
 
     def linearity(self, e: np.ndarray=None):
         """ Large if similar to a 1D line (Weinmann et al. ISPRS 2014)
@@ -447,7 +747,9 @@ class Segment(Object):
             self.extent,
             self.semantic_descriptor,
             self.first_seen,
-            self.last_seen
+            self.last_seen,
+            self._center_ref,
+            mean=self.mean
         )
             
     @property
@@ -470,6 +772,27 @@ class Segment(Object):
         #     new_obj.use_bottom_median_as_center()
         # return new_obj
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_point_buffer'] = self.points
+        state['_point_cells'] = None
+        state['_geometry'] = dict()
+        return state
+    
+    def __setstate__(self, state):
+        # segments pickled before points were stored in a buffer
+        if 'points' in state:
+            points = state.pop('points')
+            state['_point_buffer'] = points
+            state['_num_points'] = 0 if points is None else points.shape[0]
+            state['_point_cells'] = None
+            state['_num_points_at_outlier_removal'] = state['_num_points']
+            state['_point_sums'] = None
+            state['_points_version'] = 0
+            state['_geometry'] = dict()
+            state['_geometry_version'] = 0
+        self.__dict__.update(state)
+
     def to_pickle(self):
         self.reset_obb()
         return self
@@ -125,6 +125,7 @@ class DataParams:
     run_env: str = None
     time_params: dict = None
     kitti: bool = False
+    prefetch_frames: int = 0
     
     def __post_init__(self):
         if self.time_params is not None:
@@ -155,7 +156,8 @@ class DataParams:
             runs=data['runs'] if 'runs' in data else None,
             run_env=data['run_env'] if 'run_env' in data else None,
             time_params=run_data['time_params'] if 'time_params' in run_data else None,
-            kitti=run_data['kitti'] if 'kitti' in run_data else False
+            kitti=run_data['kitti'] if 'kitti' in run_data else False,
+            prefetch_frames=run_data['prefetch_frames'] if 'prefetch_frames' in run_data else 0
         )
         
     @cached_property
@@ -39,6 +39,7 @@ class FastSAMParams:
         plane_filter_params (tuple): parameters for plane filtering
         rotate_img (str): how to rotate the image ('CW', 'CCW', '180')
         clip (bool): whether to compute clip embeddings for observations
+        clip_batch_size (int): maximum number of mask crops encoded by CLIP in one forward pass
         yolo_imgsz (Tuple[int, int]): size of the YOLO image
         depth_scale (float): depth scale factor for processing depth images
         max_depth (float): maximum depth before rejecting observation points
@@ -68,6 +69,7 @@ class FastSAMParams:
     plane_filter_params: tuple = tuple([3.0, 1.0, 0.2])
     rotate_img: str = None
     clip: bool = True
+    clip_batch_size: int = 32
     yolo_imgsz: Tuple[int, int] = (256, 256)
     depth_scale: float = 1e3
     max_depth: float = 7.5
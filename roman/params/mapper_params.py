@@ -35,6 +35,10 @@ class MapperParams():
         segment_graveyard_dist (float): distance traveled after which an inactive segment is sent to the graveyard
         iou_voxel_size (float): voxel size for IOU calculation
         segment_voxel_size (float): voxel size for segment representation
+        association_cell_size (float): cell size of the spatial hash grid used to find 
+            candidate segment/observation pairs before computing voxel IOU
+        sparse_voxel_grid (bool): store IOU voxel grids as sorted occupied voxel keys rather 
+            than dense bounding box arrays
 
     Returns:
         MapperParams: params object
@@ -52,6 +56,8 @@ class MapperParams():
     segment_graveyard_dist: float = 10.0
     iou_voxel_size: float = 0.2
     segment_voxel_size: float = 0.05
+    association_cell_size: float = 1.0
+    sparse_voxel_grid: bool = True
     
     @classmethod
     def from_yaml(cls, yaml_path: str, run: str = None):
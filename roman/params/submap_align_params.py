@@ -42,6 +42,9 @@ class SubmapAlignParams:
     force_rm_upside_down: bool = True       # If true, assumes upside down submap rotations are incorrect
     use_object_bottom_middle: bool = False  # If true, uses the bottom middle of the object as a reference
                                             # point for registration rather than the center of the object
+    num_workers: int = 1                    # Number of processes used to register submap pairs in parallel
+    prefilter_min_pairs: int = 0            # If > 0, submap pairs with fewer segment pairs with semantic
+                                            # similarity above cosine_min are not registered
     
     # registration params
     sigma: float = 0.4
@@ -159,4 +159,43 @@ def expandvars_recursive(path):
         expanded_path = expandvars(path)
         if expanded_path == path:
             return expanduser(expanded_path)
-        path = expanded_path
\ No newline at end of file
+        path = expanded_path
+
+
+class UnionFind:
+    """
+    Disjoint set forest with path compression for grouping items 0, ..., n-1.
+    """
+
+    def __init__(self, n: int):
+        self.parent = list(range(n))
+
+    def find(self, a: int) -> int:
+        while self.parent[a] != a:
+            self.parent[a] = self.parent[self.parent[a]]
+            a = self.parent[a]
+        return a
+    
+    def union(self, a: int, b: int) -> int:
+        """
+        Joins the sets containing a and b. The root of the set containing the smaller of 
+        the two roots is kept as the root of the joined set.
+
+        Returns:
+            int: root of the joined set
+        """
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a > root_b:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        return root_a
+    
+    def groups(self) -> List[List[int]]:
+        """
+        Returns:
+            List[List[int]]: items grouped by set, each group in ascending order
+        """
+        groups = dict()
+        for a in range(len(self.parent)):
+            groups.setdefault(self.find(a), []).append(a)
+        return list(groups.values())